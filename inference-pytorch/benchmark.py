@@ -0,0 +1,200 @@
+import time
+import argparse
+import numpy as np
+
+from scene_utils import predictions_to_scenes
+
+
+def predictions_to_scenes_loop(predictions: np.ndarray, threshold: float = 0.5):
+    # reference per-frame implementation the vectorized `predictions_to_scenes` replaced
+    predictions = (predictions > threshold).astype(np.uint8)
+
+    scenes = []
+    t, t_prev, start = -1, 0, 0
+    for i, t in enumerate(predictions):
+        if t_prev == 1 and t == 0:
+            start = i
+        if t_prev == 0 and t == 1 and i != 0:
+            scenes.append([start, i])
+        t_prev = t
+    if t == 0:
+        scenes.append([start, i])
+
+    # just fix if all predictions are 1
+    if len(scenes) == 0:
+        return np.array([[0, len(predictions) - 1]], dtype=np.int32)
+
+    return np.array(scenes, dtype=np.int32)
+
+
+def measure(fn, *args, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start_time)
+    return result, min(times)
+
+
+def benchmark_scenes(args):
+    rng = np.random.default_rng(0)
+    # mostly low probabilities with short bursts of transitions roughly every 100 frames
+    predictions = rng.random(args.frames, dtype=np.float32) * 0.4
+    transitions = rng.integers(0, args.frames, args.frames // 100)
+    for length in range(3):
+        predictions[np.minimum(transitions + length, args.frames - 1)] = 0.9
+
+    print(f"Converting {args.frames} predictions into scenes...")
+    scenes, vectorized_time = measure(predictions_to_scenes, predictions, repeat=args.repeat)
+    print(f"vectorized: {vectorized_time:.3f}s ({len(scenes)} scenes)")
+
+    if args.skip_reference:
+        return
+    reference_scenes, reference_time = measure(predictions_to_scenes_loop, predictions)
+    print(f"loop:       {reference_time:.3f}s ({len(reference_scenes)} scenes)")
+
+    assert np.array_equal(scenes, reference_scenes), "vectorized scenes differ from the reference implementation"
+    print(f"Scenes are identical, speedup {reference_time / vectorized_time:.1f}x")
+
+
+def padded_windows_concatenate(frames):
+    # reference windowing `predict_frames` used before, copies the whole video to add the padding
+    no_padded_frames_end = 25 + 50 - (len(frames) % 50 if len(frames) % 50 != 0 else 50)
+    padded_inputs = np.concatenate([frames[:1]] * 25 + [frames] + [frames[-1:]] * no_padded_frames_end, 0)
+
+    ptr = 0
+    while ptr + 100 <= len(padded_inputs):
+        yield padded_inputs[ptr:ptr + 100]
+        ptr += 50
+
+
+def benchmark_windows(args):
+    import os
+    import tempfile
+    import tracemalloc
+    from pipeline import SlidingWindowPredictor
+
+    class NullPredictor(SlidingWindowPredictor):
+        # measures only the windowing, the network is replaced by constant predictions
+        def predict_raw(self, frames: np.ndarray):
+            predictions = np.zeros([*frames.shape[:2], 1], np.float32)
+            return predictions, predictions
+
+    predictor = NullPredictor()
+
+    def peak_memory(fn):
+        tracemalloc.start()
+        _, seconds = measure(fn)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, seconds
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        frames = np.lib.format.open_memmap(os.path.join(tmp_dir, "frames.npy"), mode="w+", dtype=np.uint8,
+                                           shape=(args.frames, *predictor.input_size))
+        print(f"Windowing {args.frames} memory-mapped frames ({frames.nbytes / 2 ** 20:.0f} MB) "
+              f"in batches of {args.batch_size} windows...")
+
+        peak, seconds = peak_memory(lambda: predictor.predict_frames(frames, batch_size=args.batch_size))
+        print(f"views:       peak {peak / 2 ** 20:8.1f} MB, {seconds:.2f}s")
+
+        if args.skip_reference:
+            return
+        peak, seconds = peak_memory(lambda: predictor._predict_windows(
+            padded_windows_concatenate(frames), args.batch_size, no_frames=len(frames)))
+        print(f"concatenate: peak {peak / 2 ** 20:8.1f} MB, {seconds:.2f}s")
+        del frames
+
+
+def benchmark_cpu(args):
+    import io
+    import torch
+    import contextlib
+    from transnetv2_pytorch import TransNetV2, TransNetV2Predictor
+
+    # throughput does not depend on the weights, random initialization is used if no weights are given
+    if args.weights is not None:
+        predictor = TransNetV2Predictor(args.weights, device="cpu")
+    else:
+        predictor = TransNetV2Predictor(model=TransNetV2(), device="cpu")
+
+    frames = np.random.default_rng(0).integers(0, 255, size=(args.frames, 27, 48, 3), dtype=np.uint8)
+    print(f"Predicting {args.frames} frames on CPU...")
+    print(f"{'threads':>8} {'batch':>6} {'frames/s':>10} {'frames/s/core':>14}")
+
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                predictor.predict_frames(frames[:100], batch_size=batch_size)  # warm-up
+                _, seconds = measure(predictor.predict_frames, frames, batch_size, repeat=args.repeat)
+
+            fps = args.frames / seconds
+            print(f"{threads:>8d} {batch_size:>6d} {fps:>10.1f} {fps / threads:>14.1f}")
+
+
+def benchmark_fuse(args):
+    import copy
+    import torch
+    from transnetv2_pytorch import TransNetV2
+
+    torch.set_num_threads(args.threads)
+    model = TransNetV2().eval()
+    if args.weights is not None:
+        model.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    fused_model = copy.deepcopy(model).fuse()
+
+    inputs = torch.randint(0, 255, (args.batch_size, 100, 27, 48, 3), dtype=torch.uint8)
+    print(f"Predicting {args.batch_size}x100 frames on CPU with {args.threads} threads...")
+
+    outputs = {}
+    for name, m in [("unfused", model), ("fused", fused_model)]:
+        with torch.inference_mode():
+            m(inputs)  # warm-up
+            (outputs[name], _), seconds = measure(m, inputs, repeat=args.repeat)
+        print(f"{name + ':':<8} {args.batch_size * 100 / seconds:.1f} frames/s")
+
+    max_diff = (outputs["unfused"] - outputs["fused"]).abs().max().item()
+    print(f"Max. absolute difference of logits {max_diff:.2e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the inference pipeline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    scenes_parser = subparsers.add_parser("scenes", help="predictions_to_scenes, vectorized vs. loop")
+    scenes_parser.add_argument("--frames", type=int, default=10_000_000, help="Number of frames. Default 10M")
+    scenes_parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions. Default 3")
+    scenes_parser.add_argument("--skip_reference", action="store_true", help="Do not run the slow loop")
+    scenes_parser.set_defaults(func=benchmark_scenes)
+
+    windows_parser = subparsers.add_parser("windows", help="predict_frames windowing memory, views vs. concatenate")
+    windows_parser.add_argument("--frames", type=int, default=500_000, help="Number of frames. Default 500k")
+    windows_parser.add_argument("--batch_size", type=int, default=8, help="Number of windows per batch. Default 8")
+    windows_parser.add_argument("--skip_reference", action="store_true",
+                                help="Do not run the reference, it needs memory for a copy of all frames")
+    windows_parser.set_defaults(func=benchmark_windows)
+
+    cpu_parser = subparsers.add_parser("cpu", help="TransNetV2Predictor throughput on CPU")
+    cpu_parser.add_argument("--weights", type=str, default=None, help="Path to the pytorch weights. Default random")
+    cpu_parser.add_argument("--frames", type=int, default=1000, help="Number of frames. Default 1000")
+    cpu_parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4],
+                            help="Numbers of intra-op threads to test. Default 1 2 4")
+    cpu_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8],
+                            help="Numbers of windows per forward pass to test. Default 1 8")
+    cpu_parser.add_argument("--repeat", type=int, default=1, help="Number of repetitions. Default 1")
+    cpu_parser.set_defaults(func=benchmark_cpu)
+
+    fuse_parser = subparsers.add_parser("fuse", help="TransNetV2 forward on CPU, fused vs. unfused convolutions")
+    fuse_parser.add_argument("--weights", type=str, default=None, help="Path to the pytorch weights. Default random")
+    fuse_parser.add_argument("--batch_size", type=int, default=8, help="Number of 100-frame windows. Default 8")
+    fuse_parser.add_argument("--threads", type=int, default=4, help="Number of intra-op threads. Default 4")
+    fuse_parser.add_argument("--repeat", type=int, default=5, help="Number of repetitions. Default 5")
+    fuse_parser.set_defaults(func=benchmark_fuse)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import numpy as np
 import tensorflow as tf
 
 import transnetv2_pytorch
+from pipeline import SlidingWindowPredictor, test_predictors
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 
@@ -109,6 +110,17 @@ def test_models(torch_model, tf_model):
               f"{many * 100:5.1f}% of 'many' predictions matching")
 
 
+class TFPredictor(SlidingWindowPredictor):
+    # the same sliding window inference as in `inference/transnetv2.py` on top of the loaded saved model
+
+    def __init__(self, tf_model):
+        self.tf_model = tf_model
+
+    def predict_raw(self, frames: np.ndarray):
+        logits, dict_ = self.tf_model(tf.cast(frames, tf.float32))
+        return tf.sigmoid(logits).numpy(), tf.sigmoid(dict_["many_hot"]).numpy()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--tf_weights", type=str, help="path to TransNet V2 weights",
@@ -123,6 +135,8 @@ def main():
 
     if args.test:
         test_models(torch_model, tf_model)
+        test_predictors(transnetv2_pytorch.TransNetV2Predictor(model=torch_model), TFPredictor(tf_model),
+                        "pytorch and tensorflow")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import torch
+import argparse
+
+from onnx_predictor import TransNetV2ONNXPredictor
+from pipeline import test_predictors
+from transnetv2_pytorch import TransNetV2, TransNetV2Predictor, export_onnx
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export TransNet V2 into ONNX")
+    parser.add_argument("--weights", type=str, default="transnetv2-pytorch-weights.pth",
+                        help="Path to the pytorch weights. Default transnetv2-pytorch-weights.pth")
+    parser.add_argument("--output", type=str, default="transnetv2.onnx",
+                        help="Path to the ONNX model. Default transnetv2.onnx")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version. Default 17")
+    parser.add_argument("--test", action="store_true", help="compare predictions with the pytorch backend")
+    parser.add_argument("--tf_weights", type=str, default=None,
+                        help="With --test, compare predictions also with the tensorflow backend using these weights")
+    args = parser.parse_args()
+
+    model = TransNetV2()
+    model.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    model.eval()
+
+    print(f"Saving model to {args.output}")
+    export_onnx(model, args.output, opset_version=args.opset)
+
+    if args.test:
+        onnx_predictor = TransNetV2ONNXPredictor(args.output)
+        test_predictors(onnx_predictor, TransNetV2Predictor(model=model), "ONNX Runtime and pytorch")
+
+        if args.tf_weights is not None:
+            import tensorflow as tf
+            from convert_weights import TFPredictor
+            test_predictors(onnx_predictor, TFPredictor(tf.saved_model.load(args.tf_weights)),
+                            "ONNX Runtime and tensorflow")
+
+
+if __name__ == "__main__":
+    main()
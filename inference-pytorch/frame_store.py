@@ -0,0 +1,120 @@
+import os
+import struct
+import numpy as np
+from fractions import Fraction
+
+from pipeline import iterate_video_chunks, open_video_pipe, read_frames_into  # re-exported
+
+FRAME_STORE_EXTENSION = ".frames"
+
+# magic, version, height, width, channels, number of frames, fps; padded to HEADER_SIZE bytes
+_HEADER_FORMAT = "<8sIIIIQd"
+_MAGIC = b"TNV2FRM\0"
+_VERSION = 1
+HEADER_SIZE = 64
+
+
+class FrameStore:
+    """
+    Packed store of all frames of a single video: a 64 byte header (frame count, height, width, fps)
+    followed by raw uint8 frames [num_frames, height, width, 3]. Frames are memory-mapped, not read.
+    Scenes are addressed by inclusive (start, end) frame index ranges as returned by `predictions_to_scenes`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) != HEADER_SIZE or not header.startswith(_MAGIC):
+            raise ValueError(f"{path} is not a frame store file")
+
+        _, version, self.height, self.width, channels, self.num_frames, self.fps = \
+            struct.unpack_from(_HEADER_FORMAT, header)
+        if version != _VERSION:
+            raise ValueError(f"Unsupported frame store version {version} of {path}")
+
+        shape = (self.num_frames, self.height, self.width, channels)
+        if self.num_frames == 0:
+            self.frames = np.zeros(shape, dtype=np.uint8)
+        else:
+            self.frames = np.memmap(path, dtype=np.uint8, mode="r", offset=HEADER_SIZE, shape=shape)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    def scene(self, start: int, end: int):
+        """Returns view of frames `start` to `end` (inclusive)."""
+        return self.frames[start:end + 1]
+
+    def scenes(self, ranges):
+        """Yields views of frames of each (start, end) range of `ranges`."""
+        for start, end in ranges:
+            yield self.scene(start, end)
+
+
+class FrameStoreWriter:
+    """
+    Writes frames coming in chunks of arbitrary size into a frame store file.
+    The file is written under a temporary name and renamed by `close`, so readers never see partial stores.
+    """
+
+    def __init__(self, path: str, height: int = 27, width: int = 48, fps: float = 0.):
+        self.path = path
+        self.height, self.width, self.fps = height, width, fps
+        self.num_frames = 0
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        header = struct.pack(_HEADER_FORMAT, _MAGIC, _VERSION, self.height, self.width, 3, self.num_frames, self.fps)
+        self._file.seek(0)
+        self._file.write(header.ljust(HEADER_SIZE, b"\0"))
+
+    def write(self, frames: np.ndarray):
+        assert frames.dtype == np.uint8 and frames.shape[1:] == (self.height, self.width, 3), \
+            f"Frames must be np.uint8 array of shape [frames, {self.height}, {self.width}, 3]."
+        self._file.write(np.ascontiguousarray(frames).data)
+        self.num_frames += len(frames)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._write_header()
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """Closes the writer and removes the partially written file."""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def get_frame_rate(video_path: str):
+    import ffmpeg
+
+    probe = ffmpeg.probe(video_path)
+    video_stream = next(stream for stream in probe["streams"] if stream["codec_type"] == "video")
+    return float(Fraction(video_stream["avg_frame_rate"]))
+
+
+def extract_frame_store(video_path: str, path: str, height: int = 27, width: int = 48, chunk_size: int = 1000):
+    """Decodes `video_path` by a single ffmpeg rawvideo pipe into frame store `path`, returns the number of frames."""
+    with FrameStoreWriter(path, height, width, get_frame_rate(video_path)) as writer:
+        for frames in iterate_video_chunks(video_path, chunk_size, height, width):
+            writer.write(frames)
+    return writer.num_frames
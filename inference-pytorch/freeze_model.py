@@ -0,0 +1,55 @@
+import time
+import torch
+import argparse
+import numpy as np
+
+from transnetv2_pytorch import TransNetV2, TransNetV2Predictor, freeze_for_inference
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save TorchScript model with batch norm folded for inference")
+    parser.add_argument("--weights", type=str, default="transnetv2-pytorch-weights.pth",
+                        help="Path to the pytorch weights. Default transnetv2-pytorch-weights.pth")
+    parser.add_argument("--output", type=str, default="transnetv2-pytorch-frozen.pt",
+                        help="Path to the frozen model. Default transnetv2-pytorch-frozen.pt")
+    parser.add_argument("--device", type=str, default="cpu", help="Device the model is traced on. Default cpu")
+    parser.add_argument("--test", action="store_true", help="compare outputs and latency with the eager model")
+    args = parser.parse_args()
+
+    model = TransNetV2()
+    model.load_state_dict(torch.load(args.weights, map_location=args.device))
+    model.eval().to(args.device)
+    freeze_for_inference(model, args.output)
+    print(f"Frozen model saved into {args.output}")
+
+    if not args.test:
+        return
+
+    def load_eager():
+        eager_model = TransNetV2()
+        eager_model.load_state_dict(torch.load(args.weights, map_location=args.device))
+        return TransNetV2Predictor(device=args.device, model=eager_model)
+
+    predictors = {}
+    for name, load in [("eager", load_eager),
+                       ("frozen", lambda: TransNetV2Predictor.from_frozen(args.output, args.device))]:
+        start_time = time.perf_counter()
+        predictors[name] = load()
+        print(f"{name + ':':<7} startup {time.perf_counter() - start_time:.3f}s", end=", ")
+
+        window = np.random.default_rng(0).integers(0, 255, size=(1, 100, 27, 48, 3), dtype=np.uint8)
+        predictors[name].predict_raw(window)  # warm-up
+        start_time = time.perf_counter()
+        for _ in range(5):
+            predictors[name].predict_raw(window)
+        print(f"{(time.perf_counter() - start_time) / 5 * 1000:.1f}ms per window")
+
+    frames = np.random.default_rng(1).integers(0, 255, size=(300, 27, 48, 3), dtype=np.uint8)
+    eager, frozen = [predictors[name].predict_frames(frames, batch_size=3) for name in ("eager", "frozen")]
+    for eager_pred, frozen_pred in zip(eager, frozen):
+        np.testing.assert_allclose(eager_pred, frozen_pred, atol=1e-5)
+    print("Predictions of the eager and frozen models are the same.")
+
+
+if __name__ == "__main__":
+    main()
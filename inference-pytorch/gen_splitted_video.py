@@ -1,17 +1,118 @@
 import argparse
 import os
 import json
+import re
 import ffmpeg
 import datetime
+import shutil
+import tempfile
 
 from tqdm import tqdm
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
 
+from scene_utils import find_scenes_file, read_scenes
 
-def read_video_info(video_path: str):
+
+def read_split_file(split_path: str):
+    """
+    Read the split file, which is a text or binary .npy file, and return the list of timestamps, which is a 2d array
+    """
+    return read_scenes(split_path).tolist()
+
+
+def get_keyframes(video_path: str, fps: float):
+    """Returns set of frame indices of keyframes of the video stream, only keyframes are decoded."""
+    probe = ffmpeg.probe(video_path, select_streams="v:0", skip_frame="nokey", show_entries="frame=pts_time")
+    return {
+        round(float(frame["pts_time"]) * fps) for frame in probe.get("frames", []) if "pts_time" in frame
+    }
+
+
+def cut_scene(video_path: str, output_path: str, start_frame: int, end_frame: int, fps: float):
+    # seeks to the scene and re-encodes it, one ffmpeg process per scene
+    (
+        ffmpeg.input(video_path, ss=start_frame / fps, t=(end_frame - start_frame + 1) / fps)
+        .output(output_path)
+        .global_args("-loglevel", "error")
+        .run()
+    )
+
+
+def segment_video(video_path: str, scenes, output_paths, fps: float, stream_copy: bool = False):
+    """
+    Cuts all non-overlapping `scenes` [(start_frame, end_frame), ...] of the video in a single pass
+    by the ffmpeg segment muxer and moves the segment of the i-th scene to `output_paths[i]`.
+    Frames not contained in any scene form separate segments that are discarded.
+
+    stream_copy:
+        If True, segments are not re-encoded. Callers must ensure all cuts lie on keyframes.
+    """
+    # segment k covers frames from bounds[k] to bounds[k + 1] - 1
+    cuts = sorted({frame for start, end in scenes for frame in (start, end + 1)} - {0})
+    bounds = [0] + cuts
+
+    output_dir = os.path.dirname(output_paths[0]) if len(output_paths) > 0 else "."
+    tmp_dir = tempfile.mkdtemp(dir=output_dir)
+    try:
+        output_kwargs = {"f": "segment", "reset_timestamps": 1}
+        if len(cuts) > 0:
+            # the cut is made at the first (key)frame after the time, half a frame earlier avoids rounding errors
+            cut_times = ",".join(f"{(frame - 0.5) / fps:.6f}" for frame in cuts)
+            output_kwargs["segment_times"] = cut_times
+            if not stream_copy:
+                output_kwargs["force_key_frames"] = cut_times
+        if stream_copy:
+            output_kwargs["c"] = "copy"
+
+        (
+            ffmpeg.input(video_path)
+            .output(os.path.join(tmp_dir, "%08d" + os.path.splitext(output_paths[0])[1]), **output_kwargs)
+            .global_args("-loglevel", "error")
+            .run()
+        )
+
+        segment_index = {frame: k for k, frame in enumerate(bounds)}
+        for (start, _), output_path in zip(scenes, output_paths):
+            segment_path = os.path.join(tmp_dir, f"{segment_index[start]:08d}" + os.path.splitext(output_path)[1])
+            os.replace(segment_path, output_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def split_video(video_path: str, segment_frames, output_paths, fps: float, stream_copy: bool = False):
     """
-    Read the video file and return the metadata
+    Cuts scenes `segment_frames` [(start_frame, end_frame), ...] of the video into `output_paths`.
+    The video is decoded once, only scenes overlapping a previous scene are cut by separate ffmpeg processes.
+    If `stream_copy` is set, the video is not re-encoded when all cuts lie on keyframes.
     """
-    metadata = {}
+    # scenes overlapping (e.g. at seams of overlapping ranges) cannot be produced by a single segmentation
+    single_pass, separate = [], []
+    last_end = -1
+    for i in sorted(range(len(segment_frames)), key=lambda i: segment_frames[i][0]):
+        start, end = segment_frames[i]
+        if start > last_end:
+            single_pass.append(i)
+            last_end = end
+        else:
+            separate.append(i)
+
+    scenes = [segment_frames[i] for i in single_pass]
+    if stream_copy:
+        cuts = {frame for start, end in scenes for frame in (start, end + 1)} - {0}
+        stream_copy = cuts.issubset(get_keyframes(video_path, fps))
+        if not stream_copy:
+            print(f"Cuts of {os.path.basename(video_path)} are not aligned with keyframes, re-encoding")
+
+    if len(scenes) > 0:
+        segment_video(video_path, scenes, [output_paths[i] for i in single_pass], fps, stream_copy)
+    for i in separate:
+        cut_scene(video_path, output_paths[i], *segment_frames[i], fps)
+
+
+def process_video(video_path: str, split_path: str, output_folder: str, start_idx: int, args):
+    """Cuts the scenes of the video into files numbered from `start_idx`, returns metadata of the scenes."""
+    # Collect metadata
     probe = ffmpeg.probe(video_path)
     video_stream = next(
         (stream for stream in probe["streams"] if stream["codec_type"] == "video"),
@@ -20,31 +121,47 @@ def read_video_info(video_path: str):
     if not video_stream:
         raise ValueError("No video stream found")
 
-    duration = float(video_stream["duration"])
-    fps = eval(video_stream["avg_frame_rate"])
+    fps = float(Fraction(video_stream["avg_frame_rate"]))
     width = int(video_stream["width"])
     height = int(video_stream["height"])
+    original_name = os.path.splitext(os.path.basename(video_path))[0]
+    if args.chunked:
+        # remove the chunk index added by `preprocessing.py`
+        original_name = re.sub(r"_\d+$", "", original_name)
+    original_name = f"{original_name}.mp4"
+    extension = os.path.splitext(os.path.basename(video_path))[1].replace(".", "")
+    current_time = datetime.datetime.now().strftime("%Y:%m:%d %H:%M:%S")
 
-    metadata["duration"] = duration
-    metadata["fps"] = fps
-    metadata["width"] = width
-    metadata["height"] = height
-    return metadata
+    segment_frames = read_split_file(split_path)
+    output_filenames = [f"{str(start_idx + i).zfill(8)}.mp4" for i in range(len(segment_frames))]
+    split_video(
+        video_path,
+        segment_frames,
+        [os.path.join(output_folder, filename) for filename in output_filenames],
+        fps,
+        args.stream_copy,
+    )
 
+    metadata_list = []
+    for (start_frame, end_frame), output_filename in zip(segment_frames, output_filenames):
+        # metadata follow from the scene limits, the output files are not probed again
+        metadata = {
+            "duration": (end_frame - start_frame + 1) / fps,
+            "fps": fps,
+            "width": width,
+            "height": height,
+        }
+        metadata["source"] = args.source
+        metadata["original_name"] = original_name
+        metadata["filename"] = output_filename
+        metadata["caption"] = ""
+        metadata["caption_attributes"] = []
+        metadata["created_time"] = current_time
+        metadata["ext"] = extension
+        metadata["path"] = ""
 
-def read_split_file(split_path: str):
-    """
-    Read the split file, which is a text file, and return the list of timestamps, which is a 2d array
-    """
-    with open(split_path, "r") as f:
-        lines = f.readlines()
-        segment_frames = []
-        for line in lines:
-            start_frame, end_frame = line.strip().split(" ")
-            start_frame = int(start_frame)
-            end_frame = int(end_frame)
-            segment_frames.append([start_frame, end_frame])
-        return segment_frames
+        metadata_list.append(metadata)
+    return metadata_list
 
 
 def main(args):
@@ -84,65 +201,24 @@ def main(args):
                 print(filename)
         raise ValueError("Input files do not have the same filenames")
 
-    IDX = args.starting_idx
+    # output files are numbered in the order of videos and their scenes, independent of the processing order
+    video_filenames = sorted(os.listdir(input_video_folder))
+    split_paths = [
+        find_scenes_file(input_split_folder, os.path.splitext(video_filename)[0]) for video_filename in video_filenames
+    ]
+    start_indices = [args.starting_idx]
+    for split_path in split_paths:
+        start_indices.append(start_indices[-1] + len(read_scenes(split_path)))
 
-    metadata_list = []
-
-    outter_bar = tqdm(os.listdir(input_video_folder))
-    for video_filename in outter_bar:
-        outter_bar.set_description(f"Processing {video_filename}")
-        split_filename = os.path.splitext(video_filename)[0] + ".txt"
-        video_path = os.path.join(input_video_folder, video_filename)
-        split_path = os.path.join(input_split_folder, split_filename)
-
-        # Collect metadata
-        probe = ffmpeg.probe(video_path)
-        video_stream = next(
-            (stream for stream in probe["streams"] if stream["codec_type"] == "video"),
-            None,
+    def process(i):
+        return process_video(
+            os.path.join(input_video_folder, video_filenames[i]), split_paths[i], output_folder, start_indices[i], args
         )
-        if not video_stream:
-            raise ValueError("No video stream found")
-
-        fps = eval(video_stream["avg_frame_rate"])
-        original_name = os.path.splitext(os.path.basename(video_path))[0]
-        original_name = original_name.split("_")[0]
-        original_name = f"{original_name}.mp4"
-        extension = os.path.splitext(os.path.basename(video_path))[1].replace(".", "")
-        current_time = datetime.datetime.now().strftime("%Y:%m:%d %H:%M:%S")
-
-        segment_frames = read_split_file(split_path)
-
-        inner_bar = tqdm(enumerate(segment_frames), leave=False)
-        for i, (start_frame, end_frame) in inner_bar:
-            inner_bar.set_description(f"Processing {video_filename} with segment {i}")
-            idx_str = str(IDX).zfill(8)
-            output_filename = f"{idx_str}.mp4"
-            output_path = os.path.join(output_folder, output_filename)
-
-            start_time = start_frame / fps
-            duration = (end_frame - start_frame + 1) / fps
-
-            (
-                ffmpeg.input(video_path, ss=start_time, t=duration)
-                .output(output_path)
-                .global_args("-loglevel", "error")
-                .run()
-            )
-
-            IDX += 1
-
-            metadata = read_video_info(output_path)
-            metadata["source"] = args.source
-            metadata["original_name"] = original_name
-            metadata["filename"] = output_filename
-            metadata["caption"] = ""
-            metadata["caption_attributes"] = []
-            metadata["created_time"] = current_time
-            metadata["ext"] = extension
-            metadata["path"] = ""
-
-            metadata_list.append(metadata)
+
+    # the work is done by ffmpeg processes, threads are enough to run them in parallel
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        outter_bar = tqdm(executor.map(process, range(len(video_filenames))), total=len(video_filenames))
+        metadata_list = [metadata for video_metadata in outter_bar for metadata in video_metadata]
 
     json_output_path = os.path.join(output_folder, "metadata.json")
     with open(json_output_path, "w") as f:
@@ -169,5 +245,21 @@ if __name__ == "__main__":
         default=0,
         help="Starting index for the output file. Default 0",
     )
+    parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help="Input videos are chunks written by preprocessing.py, their chunk index is removed from the original name",
+    )
+    parser.add_argument(
+        "--stream_copy",
+        action="store_true",
+        help="Do not re-encode videos whose scene cuts all lie on keyframes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of videos processed in parallel. Default 1",
+    )
     args = parser.parse_args()
     main(args)
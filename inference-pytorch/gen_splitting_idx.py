@@ -1,41 +1,44 @@
 import torch
-from transnetv2_pytorch import TransNetV2
+from transnetv2_pytorch import TransNetV2, TransNetV2Predictor, histogram_scatter_plan
 import numpy as np
+import ffmpeg
 import sys
 import os
 from PIL import Image
 import argparse
 from tqdm import tqdm
 import shutil
+import time
 
+from frame_store import FRAME_STORE_EXTENSION, FrameStore, iterate_video_chunks, open_video_pipe, \
+    read_frames_into
+from pipeline import StageThroughput, prefetch, timed
+from scene_utils import SCENE_FILE_FORMATS, predictions_to_scenes, save_scenes
 
-def prepare_model():
-    model = TransNetV2()
-    state_dict = torch.load("transnetv2-pytorch-weights.pth")
-    model.load_state_dict(state_dict)
-    model.eval().cuda()
-    return model
 
+def get_device(device=None):
+    # prefer GPU if available, but run anywhere
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
 
-def predictions_to_scenes(predictions: np.ndarray, threshold: float = 0.5):
-    predictions = (predictions > threshold).astype(np.uint8)
 
-    scenes = []
-    t, t_prev, start = -1, 0, 0
-    for i, t in enumerate(predictions):
-        if t_prev == 1 and t == 0:
-            start = i
-        if t_prev == 0 and t == 1 and i != 0:
-            scenes.append([start, i])
-        t_prev = t
-    if t == 0:
-        scenes.append([start, i])
+def configure_threads(threads=None, interop_threads=None):
+    # must be called before any model is run, pytorch cannot change inter-op threads afterwards
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
 
-    # just fix if all predictions are 1
-    if len(scenes) == 0:
-        return np.array([[0, len(predictions) - 1]], dtype=np.int32)
 
-    return np.array(scenes, dtype=np.int32)
+def prepare_model(weights="transnetv2-pytorch-weights.pth", device=None):
+    device = get_device(device)
+    model = TransNetV2()
+    state_dict = torch.load(weights, map_location=device)
+    model.load_state_dict(state_dict)
+    model.eval().to(device)
+    return model
+
 
 def split_range(start, end, range_limit):
     ranges = []
@@ -48,35 +51,181 @@ def split_range(start, end, range_limit):
     
     return ranges
 
-def load_video_frame(frames_folder, frame_height=27, frame_width=48, range=10000):
+def merge_range_predictions(range_predictions):
+    """
+    Merges per-frame predictions [(predictions, (start, end)), ...] of the overlapping ranges of `split_range`
+    into predictions of the whole video. Each frame of an overlap is taken from the range
+    in which it is further from the range border, i.e. the centre part of each range is kept.
+    """
+    merged = []
+    next_frame = 0  # first frame not taken yet
+    for i, (predictions, (start, end)) in enumerate(range_predictions):
+        if i + 1 < len(range_predictions):
+            next_start = range_predictions[i + 1][1][0]
+            # frames up to the middle of the overlap [next_start, end] are closer to the centre of this range
+            cut = min(end + 1, max(next_start, (next_start + end) // 2 + 1))
+        else:
+            cut = end + 1
+        merged.append(predictions[next_frame - start:cut - start])
+        next_frame = cut
+
+    if len(merged) == 0:
+        return np.zeros([0], np.float32)
+    return np.concatenate(merged)
+
+
+def iterate_video_frame(frames_folder, frame_height=27, frame_width=48, range=10000):
+    """
+    Lazily loads the frames of `frames_folder` range by range,
+    yields tensors of shape [1, num_frames_in_range, frame_height, frame_width, 3] with their (start, end) range.
+    """
     # Get the list of frame files and sort them
     frame_files = sorted([f for f in os.listdir(frames_folder) if f.endswith(".jpg")])
     num_frames = len(frame_files)
 
     ranges = split_range(0, num_frames-1, range)
 
-    video_images_list = []
     for (start_frame, end_frame) in ranges:
-        num_frames_in_range = end_frame - start_frame + 1
-
-        # Initialize a tensor to hold the video frames
-        video_images = torch.zeros(
-            1, num_frames_in_range, frame_height, frame_width, 3, dtype=torch.uint8
-        )
+        frame_paths = [os.path.join(frames_folder, f) for f in frame_files[start_frame:end_frame+1]]
+        video_images = torch.from_numpy(read_jpeg_frames(frame_paths, frame_height, frame_width)[None])
+
+        yield video_images, (start_frame, end_frame)
+
+
+def read_jpeg_frames(frame_paths, frame_height=27, frame_width=48):
+    """Returns uint8 array [len(frame_paths), frame_height, frame_width, 3] of the resized frames."""
+    # Initialize an array to hold the video frames
+    video_images = np.zeros([len(frame_paths), frame_height, frame_width, 3], dtype=np.uint8)
+    for i, frame_path in enumerate(frame_paths):
+        image = Image.open(frame_path).convert("RGB")  # Ensure image is in RGB format
+        image = image.resize((frame_width, frame_height))
+        video_images[i] = np.array(image)
+    return video_images
+
+
+def iterate_video_file(video_path, frame_height=27, frame_width=48, range=10000):
+    """
+    Same as `iterate_video_frame`, but decodes the video file directly by a single ffmpeg rawvideo pipe.
+    Frames are read into preallocated buffers, only the overlap of consecutive ranges is copied.
+    """
+    with open_video_pipe(video_path, frame_height, frame_width) as stream:
+        # a new buffer is used for each range as the previous one can still be used by the model
+        buffer = np.empty([range, frame_height, frame_width, 3], dtype=np.uint8)
+        num_frames = read_frames_into(stream, buffer)
+        start_frame = 0
+        while num_frames > 0:
+            end_frame = start_frame + num_frames - 1
+            yield torch.from_numpy(buffer[None, :num_frames]), (start_frame, end_frame)
+            if num_frames < range:
+                break
+
+            # the next range starts in the middle of the current one, see `split_range`
+            next_start_frame = (start_frame + end_frame) // 2 + 1
+            overlap = end_frame - next_start_frame + 1
+            next_buffer = np.empty_like(buffer)
+            next_buffer[:overlap] = buffer[num_frames - overlap:num_frames]
+            num_new_frames = read_frames_into(stream, next_buffer[overlap:])
+            if num_new_frames == 0:
+                break
+            buffer, start_frame, num_frames = next_buffer, next_start_frame, overlap + num_new_frames
+
+
+def iterate_frame_array(frames, range=10000):
+    """Same as `iterate_video_frame` for uint8 array [num_frames, height, width, 3], e.g. a memory-mapped .npy file."""
+    for start_frame, end_frame in split_range(0, len(frames) - 1, range):
+        yield torch.from_numpy(np.array(frames[None, start_frame:end_frame + 1])), (start_frame, end_frame)
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".m4v", ".mpg", ".mpeg", ".ts", ".flv", ".wmv")
+
+
+def is_supported_input(path):
+    """Whether `path` is a folder of JPEG frames, a frame store, a .npy frame file or a video file."""
+    if os.path.isdir(path):
+        return True
+    return path.lower().endswith((FRAME_STORE_EXTENSION, ".npy") + VIDEO_EXTENSIONS)
+
+
+def iterate_input(path, range=10000):
+    """
+    Yields frame ranges of a folder of JPEG frames, a frame store (both see `mp4_to_frames.py`),
+    a .npy file of uint8 frames or a video file, based on the type of `path`.
+    """
+    if os.path.isdir(path):
+        return iterate_video_frame(path, range=range)
+    if path.endswith(FRAME_STORE_EXTENSION):
+        return iterate_frame_array(FrameStore(path).frames, range=range)
+    if path.endswith(".npy"):
+        return iterate_frame_array(np.load(path, mmap_mode="r"), range=range)
+    return iterate_video_file(path, range=range)
+
+
+def iterate_chunks(path, chunk_size=1000):
+    """
+    Yields consecutive, non-overlapping uint8 arrays [<=chunk_size, 27, 48, 3] of all frames of `path`,
+    which is any input accepted by `iterate_input`.
+    """
+    if os.path.isdir(path):
+        frame_files = sorted([f for f in os.listdir(path) if f.endswith(".jpg")])
+        for start in range(0, len(frame_files), chunk_size):
+            yield read_jpeg_frames([os.path.join(path, f) for f in frame_files[start:start + chunk_size]])
+        return
+
+    if path.endswith(FRAME_STORE_EXTENSION) or path.endswith(".npy"):
+        frames = FrameStore(path).frames if path.endswith(FRAME_STORE_EXTENSION) else np.load(path, mmap_mode="r")
+        for start in range(0, len(frames), chunk_size):
+            yield np.array(frames[start:start + chunk_size])
+        return
+
+    yield from iterate_video_chunks(path, chunk_size)
 
-        frame_files_in_range = frame_files[start_frame:end_frame+1]
-        for i, frame_file in enumerate(frame_files_in_range):
-            frame_path = os.path.join(frames_folder, frame_file)
-            image = Image.open(frame_path).convert("RGB")  # Ensure image is in RGB format
-            image = image.resize((frame_width, frame_height))
-            frame = np.array(image)
-            video_images[0, i] = torch.tensor(frame, dtype=torch.uint8)
 
+def load_video_frame(frames_folder, frame_height=27, frame_width=48, range=10000):
+    video_images_list, ranges = [], []
+    for video_images, frame_range in iterate_video_frame(frames_folder, frame_height, frame_width, range):
         video_images_list.append(video_images)
+        ranges.append(frame_range)
 
     return video_images_list, ranges
 
 
+def is_out_of_memory(exc):
+    """Whether `exc` is an allocation failure of the CPU or an accelerator."""
+    if isinstance(exc, MemoryError):
+        return True
+    message = str(exc)
+    return any(text in message for text in ("out of memory", "can't allocate memory", "not enough memory"))
+
+
+def predict_ranges(model, device, input_path, range=1500, prefetch_size=2):
+    """
+    Returns single-frame predictions of all frames of `input_path` computed range by range,
+    together with throughput of the decoding and inference stages.
+    """
+    # frames are loaded in a background thread while the model processes the previous range
+    decode_stats, inference_stats = StageThroughput("decoding"), StageThroughput("inference")
+    video_ranges = timed(
+        iterate_input(input_path, range=range), decode_stats, count=lambda x: x[0].shape[1]
+    )
+    if prefetch_size > 0:
+        video_ranges = prefetch(video_ranges, max_queue_size=prefetch_size)
+
+    range_predictions = []
+    for video_images, frame_range in video_ranges:
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            single_frame_pred, _ = model(video_images.to(device))
+            single_frame_pred = torch.sigmoid(single_frame_pred).cpu().numpy()
+        inference_stats.add(video_images.shape[1], time.perf_counter() - start_time)
+
+        range_predictions.append((single_frame_pred[0, :, 0], frame_range))
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    # predictions of overlapping ranges are merged before thresholding, so scenes do not overlap at seams
+    return merge_range_predictions(range_predictions), decode_stats, inference_stats
+
+
 def main(args):
     input_folder = args.input
     assert os.path.isdir(input_folder), f"Input folder {input_folder} does not exist"
@@ -85,9 +234,17 @@ def main(args):
     # Clear the output folder
     os.makedirs(output_folder, exist_ok=True)
 
-    model = prepare_model()
+    configure_threads(args.threads, args.interop_threads)
+    device = get_device(args.device)
+    model = prepare_model(args.weights, device)
+    if args.fuse:
+        model.fuse()
+    print(f"Running on {device} with {torch.get_num_threads()} threads")
+    predictor = TransNetV2Predictor(device=device, model=model)
 
+    # sizes are halved on out of memory errors and the smaller size is kept for the following videos
     range = args.range
+    batch_size = args.batch_size
 
     skipped_videos = []
     error_message_path = os.path.join(output_folder, "error_message.txt")
@@ -95,13 +252,14 @@ def main(args):
     #     os.remove(error_message_path)
     # open(error_message_path, "w").close()
 
-    progress_bar = tqdm(os.listdir(input_folder))
-    for video_name in progress_bar:
-        frame_folder = os.path.join(input_folder, video_name)
-        if not os.path.isdir(frame_folder):
-            continue
+    # other files in the input folder, e.g. notes or .DS_Store, are ignored
+    filenames = [f for f in sorted(os.listdir(input_folder)) if is_supported_input(os.path.join(input_folder, f))]
+    progress_bar = tqdm(filenames)
+    for filename in progress_bar:
+        input_path = os.path.join(input_folder, filename)
+        video_name = filename if os.path.isdir(input_path) else os.path.splitext(filename)[0]
 
-        if len(os.listdir(frame_folder)) == 0:
+        if os.path.isdir(input_path) and len(os.listdir(input_path)) == 0:
             print(f"Skipping {video_name} as the folder is empty")
             skipped_videos.append(video_name)
             # with open(error_message_path, "a") as f:
@@ -109,45 +267,67 @@ def main(args):
             continue
 
         progress_bar.set_description(f"Processing {video_name}")
-        # frames = load_video_frame(frame_folder, range=range)
-        video_images_list, ranges = load_video_frame(frame_folder, range=range)
-
-        try:
-            output_list = []
-            for video_images, (start_frame, _) in zip(video_images_list, ranges):
-                single_frame_pred, _ = model(video_images.cuda())
-
-                single_frame_pred = torch.sigmoid(single_frame_pred).detach().cpu().numpy()
-
-                output = predictions_to_scenes(single_frame_pred[0])
-                output += start_frame
-                output_list.append(output)
-                video_images.cpu()
-                torch.cuda.empty_cache()
-
-            output_np = np.concatenate(output_list, axis=0)
-            output_file = os.path.join(output_folder, f"{video_name}.txt")
-            np.savetxt(output_file, output_np, fmt="%d")
-
-        except RuntimeError as e:
-            if "out of memory" in str(e):
-                print("CUDA out of memory. Skipping this iteration.")
-                torch.cuda.empty_cache()  # Clear GPU memory cache
+        single_frame_pred = None
+        while True:
+            try:
+                if args.stream:
+                    # the whole video is processed by 100-frame sliding windows, memory does not grow with its length
+                    single_frame_pred, _ = predictor.predict_stream(
+                        iterate_chunks(input_path, args.chunk_size), batch_size, args.prefetch
+                    )
+                else:
+                    single_frame_pred, decode_stats, inference_stats = predict_ranges(
+                        model, device, input_path, range, args.prefetch
+                    )
+                    progress_bar.write(f"{video_name}: {decode_stats}, {inference_stats}")
+                break
+
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory(e):
+                    raise e  # Re-raise the exception if it is not related to OOM
+                histogram_scatter_plan.cache_clear()  # release cached plans of the failed range size
+                if device.type == "cuda":
+                    torch.cuda.empty_cache()  # Clear GPU memory cache
+
+                if args.stream and batch_size > 1:
+                    batch_size //= 2
+                    print(f"Out of memory. Retrying {video_name} with batch size {batch_size}.")
+                elif not args.stream and range // 2 >= args.min_range:
+                    range //= 2
+                    print(f"Out of memory. Retrying {video_name} with range {range}.")
+                else:
+                    print(f"Out of memory at the smallest size. Skipping {video_name}.")
+                    skipped_videos.append(video_name)
+                    # with open(error_message_path, "a") as f:
+                    #     f.write(f"{video_name}: {str(e)}\n")
+                    break
+            except ffmpeg.Error as e:
+                print(f"Error decoding {video_name}: {e.stderr.decode()}")
                 skipped_videos.append(video_name)
-                # with open(error_message_path, "a") as f:
-                #     f.write(f"{video_name}: {str(e)}\n")
-            else:
-                raise e  # Re-raise the exception if it is not related to CUDA OOM
-        
+                break
+
+        if single_frame_pred is None:
+            continue
+        if len(single_frame_pred) == 0:
+            print(f"Skipping {video_name} as it has no frames")
+            skipped_videos.append(video_name)
+            continue
+
+        scenes = predictions_to_scenes(single_frame_pred, args.threshold)
+        save_scenes(os.path.join(output_folder, video_name), scenes, args.output_format)
 
     if len(skipped_videos) > 0:
-        print(f"Skipped videos due to CUDA out of memory: {skipped_videos}")
+        print(f"Skipped videos: {skipped_videos}")
     print(f"Output files are saved in {output_folder}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Split video into scenes")
-    parser.add_argument("--input", type=str, help="Path to the video file")
+    parser.add_argument(
+        "--input",
+        type=str,
+        help="Path to the folder with video files, frame stores, .npy frame files or folders of JPEG frames",
+    )
     parser.add_argument("--output", type=str, help="Path to the output folder")
     parser.add_argument(
         "--threshold",
@@ -156,5 +336,62 @@ if __name__ == "__main__":
         help="Threshold for scene change detection. Default 0.5",
     )
     parser.add_argument("--range", type=int, default=1500, help="Range limit")
+    parser.add_argument(
+        "--min_range",
+        type=int,
+        default=100,
+        help="Smallest range limit the range is halved to on out of memory errors. Default 100",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Process whole videos of any length in a single pass by overlapping 100-frame windows "
+        "instead of ranges, no preprocessing into chunks is needed",
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=1000, help="Number of frames decoded at once with --stream. Default 1000"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="Number of windows per forward pass with --stream, halved on out of memory errors. Default 8"
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=SCENE_FILE_FORMATS,
+        default="txt",
+        help="Save scenes as text or binary int32 .npy files. Default txt",
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default="transnetv2-pytorch-weights.pth",
+        help="Path to the pytorch weights. Default transnetv2-pytorch-weights.pth",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="Device to run the model on, e.g. cpu or cuda:0. Default cuda if available, otherwise cpu",
+    )
+    parser.add_argument(
+        "--fuse",
+        action="store_true",
+        help="Fuse convolutions and batch normalization of the loaded model for faster inference",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="Number of intra-op CPU threads. Default pytorch default"
+    )
+    parser.add_argument(
+        "--interop_threads",
+        type=int,
+        default=None,
+        help="Number of inter-op CPU threads. Default pytorch default",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of ranges loaded ahead while the model is running, 0 disables prefetching. Default 2",
+    )
     args = parser.parse_args()
     main(args)
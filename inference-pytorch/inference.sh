@@ -4,7 +4,7 @@
 input=$1
 output=$2
 source=$3
-max_frames=${4:-1000}  # Default value is 1000 if not provided
+max_frames=${4:-0}  # Default value is 0, videos are processed directly without splitting into chunks
 
 # Check if directory exists
 if [ ! -d "$input" ]; then
@@ -12,6 +12,16 @@ if [ ! -d "$input" ]; then
     exit 1
 fi
 
+if [ "$max_frames" -eq 0 ]; then
+    # long videos are processed in a single pass with bounded memory, no intermediate chunks or frames are written
+    echo ====================step1====================
+    python ./gen_splitting_idx.py --input $input --output $output/video_splitting_info --stream
+
+    echo ====================step2====================
+    python ./gen_splitted_video.py --input_video $input --input_split $output/video_splitting_info --output $output/video_output --source $source
+    exit 0
+fi
+
 # Find and run all Python files in the directory
 echo ====================step1====================
 python ./preprocessing.py --input $input --output $output/video_preprocessed --max_frames $max_frames
@@ -20,7 +30,7 @@ echo ====================step2====================
 python ./mp4_to_frames.py --input $output/video_preprocessed --output $output/video_frames
 
 echo ====================step3====================
-python ./split_video.py --input $output/video_frames --output $output/video_splitting_info
+python ./gen_splitting_idx.py --input $output/video_frames --output $output/video_splitting_info
 
 echo ====================step4====================
-python ./gen_splitted_video.py --input_video $output/video_preprocessed --input_split $output/video_splitting_info --output $output/video_output --source $source
+python ./gen_splitted_video.py --input_video $output/video_preprocessed --input_split $output/video_splitting_info --output $output/video_output --source $source --chunked
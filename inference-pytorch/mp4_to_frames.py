@@ -2,6 +2,8 @@ import ffmpeg
 import os
 import argparse
 
+from frame_store import FRAME_STORE_EXTENSION, extract_frame_store
+
 
 def main(args):
     input_folder = args.input
@@ -17,6 +19,15 @@ def main(args):
             output_path = os.path.join(output_folder, os.path.splitext(filename)[0])
 
             print(f"Extracting frames from {filename} ...")
+            if args.format == "frames":
+                output_path += FRAME_STORE_EXTENSION
+                try:
+                    num_frames = extract_frame_store(input_path, output_path)
+                    print(f"{num_frames} frames from {filename} have been extracted to {output_path}")
+                except ffmpeg.Error as e:
+                    print(f"Error extracting frames from {filename}: {e.stderr.decode()}")
+                continue
+
             if not os.path.exists(output_path):
                 os.makedirs(output_path)
 
@@ -44,5 +55,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output", type=str, required=True, help="Path to the output directory"
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["frames", "jpg"],
+        default="frames",
+        help="Save frames of each video into a single packed frame store file or a folder of JPEG files. Default frames",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+
+from pipeline import SlidingWindowPredictor
+
+
+class TransNetV2ONNXPredictor(SlidingWindowPredictor):
+    """
+    ONNX Runtime counterpart of `TransNetV2Predictor` with the same `predict_raw`, `predict_frames`,
+    `predict_video` and `predictions_to_scenes` API, neither pytorch nor tensorflow is needed.
+    The model is exported by `python export_onnx.py`.
+    """
+
+    def __init__(self, model_path=None, providers=None, threads=None):
+        try:
+            import onnxruntime
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError("For `TransNetV2ONNXPredictor` `onnxruntime` needs to be installed, "
+                                      "install it by `pip install onnxruntime`.")
+
+        if model_path is None:
+            model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transnetv2.onnx")
+        if not os.path.isfile(model_path):
+            raise FileNotFoundError(f"[TransNetV2] ERROR: {model_path} does not exist, "
+                                    f"export the model by `python export_onnx.py` first.")
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=providers or ["CPUExecutionProvider"])
+
+    def predict_raw(self, frames: np.ndarray):
+        assert len(frames.shape) == 5 and frames.shape[2:] == self.input_size, \
+            "[TransNetV2] Input shape must be [batch, frames, height, width, 3]."
+
+        single_frame_pred, all_frames_pred = self.session.run(
+            ["single_frame", "many_hot"], {"frames": np.ascontiguousarray(frames, dtype=np.uint8)})
+        return single_frame_pred, all_frames_pred
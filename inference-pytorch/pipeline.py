@@ -0,0 +1,21 @@
+"""
+Backend independent inference shared with the tensorflow package, see `inference/sliding_window.py`.
+The module does not import tensorflow, so it is imported from the `inference` folder of this repository.
+"""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "inference"))
+
+from sliding_window import (
+    SlidingWindowPredictor,
+    SlidingWindows,
+    StageThroughput,
+    iterate_video_chunks,
+    open_video_pipe,
+    predictions_to_scenes,
+    prefetch,
+    read_frames_into,
+    test_predictors,
+    timed,
+)
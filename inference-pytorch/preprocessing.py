@@ -3,9 +3,9 @@ import argparse
 import shutil
 import ffmpeg
 import time
-import math
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def get_video_metadata(video_path):
@@ -18,7 +18,11 @@ def get_video_metadata(video_path):
     return duration, frame_rate
 
 
-def preprocess_video(video_path, output_dir, frames_per_chunk):
+def plan_chunks(video_path, output_dir, frames_per_chunk):
+    """
+    Returns list of chunks (chunk index, output path, start time, duration) the video is split into.
+    Duration is None if the video is copied as a whole.
+    """
     # Get the video duration and frame rate
     duration, frame_rate = get_video_metadata(video_path)
 
@@ -28,45 +32,102 @@ def preprocess_video(video_path, output_dir, frames_per_chunk):
 
     if num_chunks == 1:
         # If the video is shorter than the chunk duration, just copy the video
-        output_path = os.path.join(output_dir, os.path.basename(video_path))
-        shutil.copyfile(video_path, output_path)
-        return
-
-    remaining_duration = duration - num_chunks * chunk_duration
-    # if remaining_duration > 0:
-    #     print(f"Splitting video into {math.ceil(duration / chunk_duration)+1} chunks")
-    # else:
-    print(f"Splitting video into {math.ceil(duration / chunk_duration)} chunks")
-    # Create output directory
-    os.makedirs(output_dir, exist_ok=True)
+        return [(0, os.path.join(output_dir, os.path.basename(video_path)), 0, None)]
 
     # Get the original video name without the extension
     original_name = os.path.splitext(os.path.basename(video_path))[0]
 
-    # Split the video into chunks
+    chunks = []
     for i in range(num_chunks):
-        print(f"Processing chunk {i}/{math.ceil(duration / chunk_duration)}")
-        start_time = i * chunk_duration
-        output_path = os.path.join(output_dir, f"{original_name}_{i}.mp4")
-        (
-            ffmpeg.input(video_path, ss=start_time, t=chunk_duration)
-            .output(output_path)
-            .global_args("-loglevel", "error")
-            .run()  # Show only error messages
-        )
+        chunks.append((i, os.path.join(output_dir, f"{original_name}_{i}.mp4"), i * chunk_duration, chunk_duration))
 
     # Handle the last chunk if there's remaining video
     remaining_duration = duration - num_chunks * chunk_duration
     if remaining_duration > 0:
-        print(f"Processing chunk {num_chunks}/{math.ceil(duration / chunk_duration)}")
-        start_time = num_chunks * chunk_duration
-        output_path = os.path.join(output_dir, f"{original_name}_{num_chunks}.mp4")
-        (
-            ffmpeg.input(video_path, ss=start_time, t=remaining_duration)
-            .output(output_path)
-            .global_args("-loglevel", "error")
-            .run()  # Show only error messages
-        )
+        chunks.append((
+            num_chunks,
+            os.path.join(output_dir, f"{original_name}_{num_chunks}.mp4"),
+            num_chunks * chunk_duration,
+            remaining_duration,
+        ))
+    return chunks
+
+
+def split_chunk(video_path, output_path, start_time, duration, stream_copy=False, tmp_dir=None):
+    """
+    Writes a single chunk of the video, the chunk is written under a temporary name first,
+    so interrupted runs never leave partial chunks behind.
+
+    stream_copy:
+        If True, the chunk is not re-encoded, it then starts at the keyframe preceding `start_time`.
+    tmp_dir:
+        Folder of the temporary file, by default the folder of `output_path`. It should be on the same
+        file system, so the finished chunk is moved to `output_path` atomically.
+    """
+    root, ext = os.path.splitext(os.path.basename(output_path))
+    tmp_path = os.path.join(tmp_dir or os.path.dirname(output_path), f"{root}.tmp{ext}")
+    try:
+        if duration is None:
+            shutil.copyfile(video_path, tmp_path)
+        else:
+            output_kwargs = {"c": "copy"} if stream_copy else {}
+            (
+                ffmpeg.input(video_path, ss=start_time, t=duration)
+                .output(tmp_path, **output_kwargs)
+                .global_args("-loglevel", "error")
+                .run()  # Show only error messages
+            )
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def preprocess_video(video_path, output_dir, frames_per_chunk, stream_copy=False):
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = plan_chunks(video_path, output_dir, frames_per_chunk)
+    print(f"Splitting video into {len(chunks)} chunks")
+
+    for i, output_path, start_time, duration in chunks:
+        print(f"Processing chunk {i}/{len(chunks)}")
+        split_chunk(video_path, output_path, start_time, duration, stream_copy)
+
+
+class Journal:
+    """
+    Append-only log of completed (video, chunk) units.
+    Restarted runs skip the units that are recorded in the journal and whose output exists.
+    Each entry records the `settings` the chunk was split with, a journal written with other settings
+    is rejected, as its chunks have different boundaries.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").rsplit("\t", 2)
+                    if len(fields) < 2:
+                        continue
+                    entry_settings = fields[2] if len(fields) == 3 else "unknown settings"
+                    if entry_settings != settings:
+                        raise ValueError(
+                            f"Journal {path} was written with {entry_settings}, not {settings}. "
+                            f"Use the same settings to resume, or remove the journal and the output folder."
+                        )
+                    self.completed.add((fields[0], int(fields[1])))
+
+    def __contains__(self, unit):
+        return unit in self.completed
+
+    def add(self, unit):
+        with open(self.path, "a") as f:
+            f.write(f"{unit[0]}\t{unit[1]}\t{self.settings}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.add(unit)
 
 
 def main(args):
@@ -81,19 +142,54 @@ def main(args):
     output_folder = args.output
 
     os.makedirs(output_folder, exist_ok=True)
+    # the journal and temporary files are kept next to the output folder, the folder must contain only the chunks
+    journal = Journal(
+        args.journal or os.path.normpath(output_folder) + ".preprocessing_journal",
+        f"max_frames={max_frames} stream_copy={args.stream_copy}",
+    )
+    # temporary files left by a killed run are incomplete chunks
+    tmp_dir = os.path.normpath(output_folder) + ".preprocessing_tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
 
     failing_videos = []
-    for video_filename in os.listdir(input_folder):
-        print(f"Preprocessing video: {video_filename}")
-        video_path = os.path.join(input_folder, video_filename)
-        start_time = time.time()
-        try:
-            preprocess_video(video_path, output_folder, max_frames)
-        except Exception as e:
-            print(f"Failed to preprocess {video_filename}: {e}")
-            failing_videos.append(video_filename)
-        end_time = time.time()
-        print(f"Video preprocessed in {end_time - start_time:.2f} seconds")
+    no_skipped = 0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for video_filename in sorted(os.listdir(input_folder)):
+            video_path = os.path.join(input_folder, video_filename)
+            try:
+                chunks = plan_chunks(video_path, output_folder, max_frames)
+            except Exception as e:
+                print(f"Failed to preprocess {video_filename}: {e}")
+                failing_videos.append(video_filename)
+                continue
+
+            for i, output_path, chunk_start_time, duration in chunks:
+                unit = (video_filename, i)
+                if unit in journal and os.path.exists(output_path):
+                    no_skipped += 1
+                    continue
+                future = executor.submit(
+                    split_chunk, video_path, output_path, chunk_start_time, duration, args.stream_copy, tmp_dir
+                )
+                futures[future] = unit
+
+        print(f"Splitting {len(futures)} chunks, {no_skipped} chunks were already split")
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            video_filename, i = futures[future]
+            try:
+                future.result()
+                journal.add((video_filename, i))
+            except Exception as e:
+                print(f"Failed to preprocess chunk {i} of {video_filename}: {e}")
+                if video_filename not in failing_videos:
+                    failing_videos.append(video_filename)
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    end_time = time.time()
+    print(f"Videos preprocessed in {end_time - start_time:.2f} seconds")
     print("All video is processed.")
 
     if len(failing_videos) > 0:
@@ -118,5 +214,22 @@ if __name__ == "__main__":
         default=500,
         help="Maximum number of frames to be extracted. Default 3000",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of chunks split in parallel. Default number of CPUs",
+    )
+    parser.add_argument(
+        "--stream_copy",
+        action="store_true",
+        help="Do not re-encode the chunks, faster but chunks start at the nearest preceding keyframe",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        default=None,
+        help="Path to the journal of split chunks used to resume interrupted runs. Default <output>.preprocessing_journal",
+    )
     args = parser.parse_args()
     main(args)
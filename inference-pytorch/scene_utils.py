@@ -0,0 +1,39 @@
+import os
+import numpy as np
+
+from pipeline import predictions_to_scenes  # re-exported
+
+SCENE_FILE_FORMATS = ("npy", "txt")
+
+
+def save_scenes(path: str, scenes: np.ndarray, output_format: str = "txt"):
+    """
+    Saves scenes [[start, end], ...] to `path` with extension given by `output_format`,
+    either as text (one scene per line) or as binary int32 `.npy` file. Returns the path of the written file.
+    """
+    assert output_format in SCENE_FILE_FORMATS, f"Unknown scene file format {output_format}"
+    path = f"{path}.{output_format}"
+    if output_format == "npy":
+        np.save(path, np.asarray(scenes, dtype=np.int32).reshape([-1, 2]))
+    else:
+        np.savetxt(path, scenes, fmt="%d")
+    return path
+
+
+def read_scenes(path: str):
+    """
+    Reads scenes saved by `save_scenes` (or `transnetv2_predict`) as int32 array of shape [n_scenes, 2].
+    Binary files are memory-mapped, not copied.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return np.loadtxt(path, dtype=np.int32, ndmin=2).reshape([-1, 2])
+
+
+def find_scenes_file(folder: str, name: str):
+    """Returns path of the scene file `name.npy` or `name.txt` in `folder`, or None if there is none."""
+    for output_format in SCENE_FILE_FORMATS:
+        path = os.path.join(folder, f"{name}.{output_format}")
+        if os.path.exists(path):
+            return path
+    return None
@@ -4,13 +4,11 @@ import argparse
 from tqdm import tqdm
 from typing import List, Tuple
 
-def extract_ranges(idx_file: str) -> List[Tuple[int, int]]:
-    ranges = []
+from frame_store import FRAME_STORE_EXTENSION
+from scene_utils import SCENE_FILE_FORMATS, find_scenes_file, read_scenes, save_scenes
 
-    with open(idx_file, "r") as file:
-        for line in file:
-            start, end = line.strip().split(" ")
-            ranges.append((int(start), int(end)))
+def extract_ranges(idx_file: str) -> List[Tuple[int, int]]:
+    ranges = [(start, end) for start, end in read_scenes(idx_file).tolist()]
 
     # Sort the ranges by start, then by end in descending order
     sorted_ranges = sorted(ranges, key=lambda x: (x[0], -x[1]))
@@ -28,48 +26,55 @@ def extract_ranges(idx_file: str) -> List[Tuple[int, int]]:
 
     return filtered_ranges
 
-def main(args):
-    frame_dir = args.frame_dir
-    idx_dir = args.idx_dir
-    output_dir = args.output_dir
-    
-    scene_names = os.listdir(frame_dir)
-    scene_names.sort()
+def link_frames(frame_folder: str, ranges: List[Tuple[int, int]], output_dir: str):
+    """Creates folder of symlinks to the JPEG frames of each range in `output_dir`."""
+    frame_file_list = [os.path.join(frame_folder, f) for f in os.listdir(frame_folder) if os.path.isfile(os.path.join(frame_folder, f))]
+    frame_file_list.sort()
 
-    frame_folders = [os.path.join(frame_dir, f) for f in os.listdir(frame_dir) if os.path.isdir(os.path.join(frame_dir, f))]
-    frame_folders.sort()
+    scene_name = os.path.basename(frame_folder)
 
-    idx_files = []
-    for scene_name in scene_names: 
-        idx_file = os.path.join(idx_dir, scene_name + ".txt")
-        idx_files.append(idx_file)
+    for idx, idx_range in enumerate(ranges):
 
-    for idx_file, frame_folder in tqdm(list(zip(idx_files, frame_folders))):
+        output_folder = os.path.join(output_dir, scene_name, f"Folder{idx+1}")
+        os.makedirs(output_folder, exist_ok=True)
 
-        if not os.path.exists(idx_file):
-            continue
+        start, end = idx_range
 
-        ranges = extract_ranges(idx_file)
-        frame_file_list = [os.path.join(frame_folder, f) for f in os.listdir(frame_folder) if os.path.isfile(os.path.join(frame_folder, f))]
-        frame_file_list.sort()
+        for i in range(start, end+1):
+            frame_file = frame_file_list[i]
+            output_file = os.path.join(output_folder, os.path.basename(frame_file))
 
-        scene_name = os.path.basename(frame_folder)
+            if os.path.lexists(output_file):
+                os.remove(output_file)
 
-        for idx, idx_range in enumerate(ranges):
+            os.symlink(frame_file, output_file)
 
-            output_folder = os.path.join(output_dir, scene_name, f"Folder{idx+1}")
-            os.makedirs(output_folder, exist_ok=True)
-            
-            start, end = idx_range
+def main(args):
+    frame_dir = args.frame_dir
+    idx_dir = args.idx_dir
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
 
-            for i in range(start, end+1):
-                frame_file = frame_file_list[i]
-                output_file = os.path.join(output_folder, os.path.basename(frame_file))
+    # folders of JPEG frames or frame store files
+    frame_paths = [os.path.join(frame_dir, f) for f in os.listdir(frame_dir)
+                   if os.path.isdir(os.path.join(frame_dir, f)) or f.endswith(FRAME_STORE_EXTENSION)]
+    frame_paths.sort()
 
-                if os.path.lexists(output_file):
-                    os.remove(output_file)
-                    
-                os.symlink(frame_file, output_file)
+    for frame_path in tqdm(frame_paths):
+        scene_name = os.path.basename(frame_path)
+        if not os.path.isdir(frame_path):
+            scene_name = scene_name[:-len(FRAME_STORE_EXTENSION)]
+
+        idx_file = find_scenes_file(idx_dir, scene_name)
+        if idx_file is None:
+            continue
+
+        ranges = extract_ranges(idx_file)
+        if os.path.isdir(frame_path):
+            link_frames(frame_path, ranges, output_dir)
+        else:
+            # frames of a frame store are not copied, scenes are read by `FrameStore(path).scenes(ranges)`
+            save_scenes(os.path.join(output_dir, scene_name), ranges, args.output_format)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Split frames based on index")
@@ -77,6 +82,7 @@ if __name__ == "__main__":
     parser.add_argument("--idx_dir", type=str, default="/homes/david/datasets/youtube_underwater_videos/split_frame_idx", help="Path to the directory containing index files")
     parser.add_argument("--output_dir", type=str, default="/homes/david/datasets/youtube_underwater_videos/split_frames", help="Path to the output directory")
 
+    parser.add_argument("--output_format", type=str, choices=SCENE_FILE_FORMATS, default="txt", help="Format of the scene range files written for frame stores. Default txt")
     args = parser.parse_args()
     main(args)
 
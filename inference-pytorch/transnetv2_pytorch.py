@@ -1,8 +1,15 @@
+import os
+import copy
 import torch
+import inspect
+import functools
 import torch.nn as nn
 import torch.nn.functional as functional
 
 import random
+import numpy as np
+
+from pipeline import SlidingWindowPredictor
 
 
 class TransNetV2(nn.Module):
@@ -48,6 +55,13 @@ class TransNetV2(nn.Module):
         self.use_mean_pooling = use_mean_pooling
         self.eval()
 
+    def fuse(self):
+        """Fuses convolutions of all `DilatedDCNNV2` blocks for faster inference, see `DilatedDCNNV2.fuse`."""
+        for module in self.modules():
+            if isinstance(module, DilatedDCNNV2):
+                module.fuse()
+        return self
+
     def forward(self, inputs):
         assert isinstance(inputs, torch.Tensor) and list(inputs.shape[2:]) == [27, 48, 3] and inputs.dtype == torch.uint8, \
             "incorrect input type and/or shape"
@@ -163,8 +177,24 @@ class DilatedDCNNV2(nn.Module):
 
         self.bn = nn.BatchNorm3d(filters * 4, eps=1e-3) if batch_norm else None
         self.activation = activation
+        self.fused = None
+
+    def fuse(self):
+        """
+        Enables faster inference path, the four spatial convolutions are computed by a single convolution
+        and batch normalization is folded into the temporal convolutions. Must be called after weights are loaded,
+        the fused path is used only in eval mode.
+        """
+        self.fused = FusedDilatedDCNNV2(self)
+        return self
 
     def forward(self, inputs):
+        if self.fused is not None and not self.training:
+            x = self.fused(inputs)
+            if self.activation is not None:
+                x = self.activation(x)
+            return x
+
         conv1 = self.Conv3D_1(inputs)
         conv2 = self.Conv3D_2(inputs)
         conv3 = self.Conv3D_4(inputs)
@@ -181,6 +211,53 @@ class DilatedDCNNV2(nn.Module):
         return x
 
 
+class FusedDilatedDCNNV2(nn.Module):
+    """Inference-only equivalent of `DilatedDCNNV2` without activation, weights are copied at construction."""
+
+    def __init__(self, block: DilatedDCNNV2):
+        super(FusedDilatedDCNNV2, self).__init__()
+
+        branches = [block.Conv3D_1, block.Conv3D_2, block.Conv3D_4, block.Conv3D_8]
+        assert all(len(branch.layers) == 2 for branch in branches), "Only separable convolutions can be fused"
+
+        with torch.no_grad():
+            spatial_weight = torch.cat([branch.layers[0].weight for branch in branches], 0)
+
+            temporal_weights, temporal_biases = [], []
+            for i, branch in enumerate(branches):
+                conv = branch.layers[1]
+                weight = conv.weight
+                bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels, device=weight.device)
+                if block.bn is not None:
+                    # batch norm of the output channels of this branch folded into the weights and bias
+                    channels = slice(i * conv.out_channels, (i + 1) * conv.out_channels)
+                    scale = block.bn.weight[channels] / torch.sqrt(block.bn.running_var[channels] + block.bn.eps)
+                    weight = weight * scale.view(-1, 1, 1, 1, 1)
+                    bias = (bias - block.bn.running_mean[channels]) * scale + block.bn.bias[channels]
+                temporal_weights.append(weight)
+                temporal_biases.append(bias)
+
+        # buffers are not part of the state dict, the original weights stay the only saved parameters
+        self.register_buffer("spatial_weight", spatial_weight.detach().clone(), persistent=False)
+        for i, (weight, bias) in enumerate(zip(temporal_weights, temporal_biases)):
+            self.register_buffer(f"temporal_weight_{i}", weight.detach().clone(), persistent=False)
+            self.register_buffer(f"temporal_bias_{i}", bias.detach().clone(), persistent=False)
+        self.dilation_rates = [branch.layers[1].dilation[0] for branch in branches]
+        self.branch_filters = branches[0].layers[0].out_channels
+
+    def forward(self, inputs):
+        x = functional.conv3d(inputs, self.spatial_weight, padding=(0, 1, 1))
+
+        outputs = []
+        for i, dilation_rate in enumerate(self.dilation_rates):
+            branch_input = x[:, i * self.branch_filters:(i + 1) * self.branch_filters]
+            outputs.append(functional.conv3d(
+                branch_input, getattr(self, f"temporal_weight_{i}"), getattr(self, f"temporal_bias_{i}"),
+                dilation=(dilation_rate, 1, 1), padding=(dilation_rate, 0, 0)
+            ))
+        return torch.cat(outputs, 1)
+
+
 class Conv3DConfigurable(nn.Module):
 
     def __init__(self,
@@ -219,6 +296,48 @@ class Conv3DConfigurable(nn.Module):
         return x
 
 
+@functools.lru_cache(maxsize=4)
+def histogram_scatter_plan(batch_size, time_window, no_pixels, device):
+    """
+    Returns bin offsets of each frame [batch_size * time_window, 1] and the scatter source of ones
+    [batch_size * time_window * no_pixels] used by `ColorHistograms`. Cached per shape and device,
+    consecutive windows of a video have the same shape, so the index tensors are not rebuilt by every forward.
+    """
+    # cached tensors must be usable both inside and outside of inference mode
+    with torch.inference_mode(False):
+        frame_bin_prefix = (torch.arange(0, batch_size * time_window, device=device) << 9).view(-1, 1)
+        ones = torch.ones(batch_size * time_window * no_pixels, dtype=torch.int32, device=device)
+    return frame_bin_prefix, ones
+
+
+def banded_similarities(x, lookup_window=101, block_size=128):
+    """
+    Returns dot products of each of the T vectors of `x` [B, T, D] with its `lookup_window` neighbours
+    as [B, T, lookup_window] tensor, neighbours outside of the sequence have similarity 0.
+    Same as gathering the diagonal band of the full [B, T, T] similarity matrix padded by zeros,
+    but only blocks of `block_size` rows of the band are computed, so time and memory are O(T * lookup_window).
+    """
+    batch_size, time_window = x.shape[0], x.shape[1]
+    x_padded = functional.pad(x, [0, 0, (lookup_window - 1) // 2, (lookup_window - 1) // 2])
+
+    blocks = []
+    for start in range(0, time_window, block_size):
+        length = min(block_size, time_window - start)
+        keys = x_padded[:, start:start + length + lookup_window - 1]
+        similarities = torch.bmm(x[:, start:start + length], keys.transpose(1, 2))  # [B, length, length + window - 1]
+        # row i of the band are elements i .. i + lookup_window - 1 of row i of the block, i.e. a strided view
+        if torch.onnx.is_in_onnx_export():
+            # as_strided cannot be exported, the rows are skewed by reshaping with one extra element per row
+            width = length + lookup_window - 1
+            skewed = functional.pad(similarities.reshape(batch_size, length * width), [0, length])
+            blocks.append(skewed.reshape(batch_size, length, width + 1)[:, :, :lookup_window])
+        else:
+            blocks.append(similarities.as_strided(
+                (batch_size, length, lookup_window), (length * (length + lookup_window - 1), length + lookup_window, 1)
+            ))
+    return torch.cat(blocks, 1)
+
+
 class FrameSimilarity(nn.Module):
 
     def __init__(self,
@@ -246,18 +365,7 @@ class FrameSimilarity(nn.Module):
         x = self.projection(x)
         x = functional.normalize(x, p=2, dim=2)
 
-        batch_size, time_window = x.shape[0], x.shape[1]
-        similarities = torch.bmm(x, x.transpose(1, 2))  # [batch_size, time_window, time_window]
-        similarities_padded = functional.pad(similarities, [(self.lookup_window - 1) // 2, (self.lookup_window - 1) // 2])
-
-        batch_indices = torch.arange(0, batch_size, device=x.device).view([batch_size, 1, 1]).repeat(
-            [1, time_window, self.lookup_window])
-        time_indices = torch.arange(0, time_window, device=x.device).view([1, time_window, 1]).repeat(
-            [batch_size, 1, self.lookup_window])
-        lookup_indices = torch.arange(0, self.lookup_window, device=x.device).view([1, 1, self.lookup_window]).repeat(
-            [batch_size, time_window, 1]) + time_indices
-
-        similarities = similarities_padded[batch_indices, time_indices, lookup_indices]
+        similarities = banded_similarities(x, self.lookup_window)  # [batch_size, time_window, lookup_window]
         return functional.relu(self.fc(similarities))
 
 
@@ -286,12 +394,17 @@ class ColorHistograms(nn.Module):
         assert no_channels == 3
         frames_flatten = frames.view(batch_size * time_window, height * width, 3)
 
+        if torch.jit.is_tracing():
+            # cached tensors would be recorded as constants of the traced shape
+            frame_bin_prefix, ones = histogram_scatter_plan.__wrapped__(
+                batch_size, time_window, height * width, frames.device)
+        else:
+            frame_bin_prefix, ones = histogram_scatter_plan(batch_size, time_window, height * width, frames.device)
         binned_values = get_bin(frames_flatten)
-        frame_bin_prefix = (torch.arange(0, batch_size * time_window, device=frames.device) << 9).view(-1, 1)
         binned_values = (binned_values + frame_bin_prefix).view(-1)
 
         histograms = torch.zeros(batch_size * time_window * 512, dtype=torch.int32, device=frames.device)
-        histograms.scatter_add_(0, binned_values, torch.ones(len(binned_values), dtype=torch.int32, device=frames.device))
+        histograms.scatter_add_(0, binned_values, ones)
 
         histograms = histograms.view(batch_size, time_window, 512).float()
         histograms_normalized = functional.normalize(histograms, p=2, dim=2)
@@ -300,19 +413,103 @@ class ColorHistograms(nn.Module):
     def forward(self, inputs):
         x = self.compute_color_histograms(inputs)
 
-        batch_size, time_window = x.shape[0], x.shape[1]
-        similarities = torch.bmm(x, x.transpose(1, 2))  # [batch_size, time_window, time_window]
-        similarities_padded = functional.pad(similarities, [(self.lookup_window - 1) // 2, (self.lookup_window - 1) // 2])
-
-        batch_indices = torch.arange(0, batch_size, device=x.device).view([batch_size, 1, 1]).repeat(
-            [1, time_window, self.lookup_window])
-        time_indices = torch.arange(0, time_window, device=x.device).view([1, time_window, 1]).repeat(
-            [batch_size, 1, self.lookup_window])
-        lookup_indices = torch.arange(0, self.lookup_window, device=x.device).view([1, 1, self.lookup_window]).repeat(
-            [batch_size, time_window, 1]) + time_indices
-
-        similarities = similarities_padded[batch_indices, time_indices, lookup_indices]
+        similarities = banded_similarities(x, self.lookup_window)  # [batch_size, time_window, lookup_window]
 
         if self.fc is not None:
             return functional.relu(self.fc(similarities))
         return similarities
+
+
+def freeze_for_inference(model: TransNetV2, path: str = None, example_batch_size: int = 1):
+    """
+    Returns TorchScript module equivalent to `model` in eval mode for inference only: batch normalization
+    is folded into convolutions (see `TransNetV2.fuse`), dropout is removed and the traced module is frozen.
+    If `path` is given, the module is saved there and can be loaded by `torch.jit.load` without this file.
+    The module is traced on 100-frame windows as used by `TransNetV2Predictor`, the batch size is dynamic.
+    """
+    model = copy.deepcopy(model).eval().fuse()
+    model.dropout = None
+
+    device = next(model.parameters()).device
+    example_inputs = torch.zeros([example_batch_size, 100, 27, 48, 3], dtype=torch.uint8, device=device)
+    with torch.no_grad():
+        traced_model = torch.jit.trace(model, example_inputs, strict=False)
+    frozen_model = torch.jit.freeze(traced_model)
+
+    if path is not None:
+        torch.jit.save(frozen_model, path)
+    return frozen_model
+
+
+class _Probabilities(nn.Module):
+    # exported graph returns single-frame and all-frames predictions after sigmoid as a plain tuple
+
+    def __init__(self, model: TransNetV2):
+        super(_Probabilities, self).__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        single_frame_pred, all_frames_pred = self.model(inputs)
+        return torch.sigmoid(single_frame_pred), torch.sigmoid(all_frames_pred["many_hot"])
+
+
+def export_onnx(model: TransNetV2, path: str, opset_version: int = 17):
+    """
+    Exports `model` into ONNX file `path` with input `frames` (uint8 [batch, frames, 27, 48, 3]) and outputs
+    `single_frame` and `many_hot` (float32 [batch, frames, 1] after sigmoid), batch and time axes are dynamic.
+    """
+    model = _Probabilities(copy.deepcopy(model)).eval()
+    device = next(model.parameters()).device
+    example_inputs = torch.zeros([1, 100, 27, 48, 3], dtype=torch.uint8, device=device)
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # the similarity band and histograms are exported by the tracing exporter
+    torch.onnx.export(
+        model, (example_inputs,), path, input_names=["frames"], output_names=["single_frame", "many_hot"],
+        dynamic_axes={"frames": {0: "batch", 1: "time"}, "single_frame": {0: "batch", 1: "time"},
+                      "many_hot": {0: "batch", 1: "time"}},
+        opset_version=opset_version, **kwargs
+    )
+
+
+class TransNetV2Predictor(SlidingWindowPredictor):
+    """
+    Pytorch counterpart of the tensorflow `TransNetV2` inference class with the same
+    `predict_raw`, `predict_frames`, `predict_video` and `predictions_to_scenes` API.
+    Runs on CPU unless a different `device` is given, `fuse` enables the faster fused convolutions.
+    """
+
+    def __init__(self, weights_path=None, device="cpu", model=None, fuse=False):
+        if model is None:
+            if weights_path is None:
+                weights_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            "transnetv2-pytorch-weights.pth")
+            if not os.path.isfile(weights_path):
+                raise FileNotFoundError(f"[TransNetV2] ERROR: {weights_path} does not exist, "
+                                        f"convert tensorflow weights by `python convert_weights.py` first.")
+
+            model = TransNetV2()
+            model.load_state_dict(torch.load(weights_path, map_location=device))
+
+        self.device = torch.device(device)
+        self.model = model.eval().to(self.device)
+        if fuse:
+            self.model.fuse()
+
+    @classmethod
+    def from_frozen(cls, path: str, device="cpu"):
+        """Loads TorchScript module saved by `freeze_for_inference`, the model class is not needed."""
+        return cls(device=device, model=torch.jit.load(path, map_location=device))
+
+    def predict_raw(self, frames: np.ndarray):
+        assert len(frames.shape) == 5 and frames.shape[2:] == self.input_size, \
+            "[TransNetV2] Input shape must be [batch, frames, height, width, 3]."
+
+        with torch.inference_mode():
+            inputs = torch.from_numpy(np.ascontiguousarray(frames)).to(self.device)
+            single_frame_pred, all_frames_pred = self.model(inputs)
+            single_frame_pred = torch.sigmoid(single_frame_pred).cpu().numpy()
+            all_frames_pred = torch.sigmoid(all_frames_pred["many_hot"]).cpu().numpy()
+
+        return single_frame_pred, all_frames_pred
@@ -1 +1 @@
-from .transnetv2 import TransNetV2
\ No newline at end of file
+from .transnetv2 import TransNetV2, StreamingDetector
\ No newline at end of file
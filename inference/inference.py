@@ -5,6 +5,7 @@ import ffmpeg
 import argparse
 
 from transnetv2 import TransNetV2
+from prediction_cache import PredictionCache, DEFAULT_CACHE_DIR
 import time
 
 
@@ -23,6 +24,12 @@ def main(args):
     print(f"Processing video folder: {video_folder}")
 
     model = TransNetV2(args.weights)
+    cache = None
+    if args.cache:
+        cache_max_size = (
+            int(args.cache_max_size * 2**20) if args.cache_max_size is not None else None
+        )
+        cache = PredictionCache(args.cache_dir, cache_max_size)
 
     failing_video = []
 
@@ -34,7 +41,20 @@ def main(args):
         print(f"Processing video {video_filename}...")
         video_path = os.path.join(video_folder, video_filename)
         start_time = time.time()
-        _, single_frame_predictions, _ = model.predict_video(video_path)
+        cached = None
+        if cache is not None:
+            cache_key = cache.key(video_path, model.fingerprint)
+            cached = cache.get(cache_key)
+
+        if cached is not None:
+            print(f"Using cached predictions for {video_filename}")
+            single_frame_predictions, _ = cached
+        else:
+            _, single_frame_predictions, all_frame_predictions = model.predict_video(
+                video_path
+            )
+            if cache is not None and single_frame_predictions is not None:
+                cache.put(cache_key, single_frame_predictions, all_frame_predictions)
         end_time = time.time()
         prediction_time = end_time - start_time
         print(f"Prediction time: {prediction_time} seconds")
@@ -92,5 +112,22 @@ if __name__ == "__main__":
         default=30,
         help="frame per second for the output video. Default is 30 fps.",
     )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse raw predictions of already processed videos (matched by content, not by name)",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help=f"path to the prediction cache, default {DEFAULT_CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--cache_max_size",
+        type=float,
+        default=None,
+        help="maximum size of the prediction cache in MB. Default unlimited",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,131 @@
+import os
+import hashlib
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "transnetv2")
+
+
+def fingerprint_file(path: str, chunk_size: int = 1 << 22):
+    """Returns sha256 hex digest of the file content, the file is read in chunks of `chunk_size` bytes."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class PredictionCache:
+    """
+    Content-addressed cache of raw per-frame predictions.
+
+    Entries are keyed by the hash of the video file bytes together with the fingerprint of the model weights,
+    so renaming a file or changing the threshold never requires running the network again.
+    Each entry is a single float32 `.npy` file of shape [n_frames, 2] (single-frame and all-frames predictions).
+    When the total size exceeds `max_size` bytes, least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size: int = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(video_fn: str, model_fingerprint: str):
+        return hashlib.sha256(f"{fingerprint_file(video_fn)}:{model_fingerprint}".encode()).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key: str):
+        """Returns (single_frame_pred, all_frames_pred) or None if the key is not cached."""
+        path = self._path(key)
+        try:
+            predictions = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        os.utime(path)  # mark as recently used
+        return predictions[:, 0], predictions[:, 1]
+
+    def put(self, key: str, single_frame_pred: np.ndarray, all_frames_pred: np.ndarray):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so that concurrent readers never see partial entries
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.stack([single_frame_pred, all_frames_pred], 1).astype(np.float32))
+        os.replace(tmp_path, path)
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def _entries(self):
+        # returns list of (last use time, size, path) of all cached entries
+        entries = []
+        for dir_path, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".npy"):
+                    continue
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # removed by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, max_size: int):
+        """Removes least recently used entries until the cache is not larger than `max_size` bytes."""
+        entries = sorted(self._entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        no_removed = 0
+        for _, size, path in entries:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+                no_removed += 1
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        return no_removed
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+            "frames": sum((size - 128) // 8 for _, size, _ in entries),  # 128B npy header, 2x float32 per frame
+            "max_size": self.max_size,
+        }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage cache of TransNet V2 predictions")
+    parser.add_argument("command", choices=["stats", "evict", "clear"],
+                        help="show cache statistics, evict least recently used entries or remove all entries")
+    parser.add_argument("--cache_dir", type=str, default=DEFAULT_CACHE_DIR,
+                        help=f"path to the cache directory, default {DEFAULT_CACHE_DIR}")
+    parser.add_argument("--max_size", type=float, default=None,
+                        help="maximum cache size in MB used by the `evict` command")
+    args = parser.parse_args()
+
+    cache = PredictionCache(args.cache_dir)
+    if args.command == "evict":
+        if args.max_size is None:
+            parser.error("`evict` requires --max_size")
+        print(f"[TransNetV2] Removed {cache.evict(int(args.max_size * 2 ** 20))} cache entries.")
+    elif args.command == "clear":
+        print(f"[TransNetV2] Removed {cache.evict(0)} cache entries.")
+
+    stats = cache.stats()
+    print(f"[TransNetV2] Cache {args.cache_dir}: {stats['entries']} videos, {stats['frames']} frames, "
+          f"{stats['size'] / 2 ** 20:.1f} MB.")
+
+
+if __name__ == "__main__":
+    main()
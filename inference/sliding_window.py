@@ -0,0 +1,445 @@
+"""
+Backend independent part of TransNet V2 inference: sliding windows, video decoding and the decoding/inference
+pipeline. Neither tensorflow nor pytorch is imported, the tensorflow `TransNetV2` and the predictors
+of `inference-pytorch` are all subclasses of `SlidingWindowPredictor`.
+"""
+import os
+import sys
+import time
+import queue
+import contextlib
+import threading
+import numpy as np
+
+
+def predictions_to_scenes(predictions: np.ndarray, threshold: float = 0.5):
+    """
+    Converts per-frame transition predictions into an int32 array of scenes [[start, end], ...].
+    A scene is a run of frames below `threshold`, its end is the first transition frame after it
+    (or the last frame of the video), both limits are inclusive.
+    """
+    predictions = (np.asarray(predictions) > threshold).astype(np.int8)
+    if len(predictions) == 0:
+        return np.array([[0, -1]], dtype=np.int32)
+
+    # edges of the thresholded signal: -1 where a scene starts, +1 where a transition starts
+    edges = np.diff(predictions)
+    starts = np.flatnonzero(edges == -1) + 1
+    ends = np.flatnonzero(edges == 1) + 1
+
+    if predictions[0] == 0:
+        starts = np.concatenate([[0], starts])
+    if predictions[-1] == 0:
+        ends = np.concatenate([ends, [len(predictions) - 1]])
+
+    # just fix if all predictions are 1
+    if len(starts) == 0:
+        return np.array([[0, len(predictions) - 1]], dtype=np.int32)
+
+    return np.stack([starts, ends], 1).astype(np.int32)
+
+
+class SlidingWindows:
+    """
+    Cuts a stream of frames into the overlapping 100-frame windows used by `SlidingWindowPredictor.predict_frames`.
+
+    Frames are added by `push` in chunks of arbitrary size and complete windows are returned immediately,
+    only the frames not yet covered by a complete window are kept in memory. `finish` pads the stream
+    by copies of the last frame exactly as `predict_frames` does and returns the remaining windows.
+    """
+
+    def __init__(self):
+        self._buffer = None
+        self.no_frames = 0
+
+    def push(self, frames: np.ndarray):
+        if len(frames) == 0:
+            return []
+
+        if self._buffer is None:
+            # the first window must be padded by 25 copies of the first frame of the video
+            self._buffer = np.repeat(frames[:1], 25, 0)
+        self._buffer = np.concatenate([self._buffer, frames], 0)
+        self.no_frames += len(frames)
+        return self._pop_windows()
+
+    def finish(self):
+        if self._buffer is None:
+            return []
+
+        no_padded_frames_end = 25 + 50 - (self.no_frames % 50 if self.no_frames % 50 != 0 else 50)  # 25 - 74
+        self._buffer = np.concatenate([self._buffer, np.repeat(self._buffer[-1:], no_padded_frames_end, 0)], 0)
+        windows = self._pop_windows()
+        self._buffer = None
+        return windows
+
+    def _pop_windows(self):
+        windows = []
+        ptr = 0
+        while ptr + 100 <= len(self._buffer):
+            windows.append(self._buffer[ptr:ptr + 100])
+            ptr += 50
+        self._buffer = self._buffer[ptr:]
+        return windows
+
+
+class SlidingWindowPredictor:
+    """
+    Videos are processed in windows of 100 frames overlapping by 50 frames, only predictions of the middle
+    50 frames of each window are used. Subclasses implement `predict_raw` for a particular backend.
+    """
+
+    input_size = (27, 48, 3)
+    show_progress = False  # print the number of processed frames after each batch
+
+    def predict_raw(self, frames: np.ndarray):
+        """
+        Takes np.uint8 array of shape [batch, frames, 27, 48, 3], returns single-frame and all-frames
+        predictions (after sigmoid) of shape [batch, frames, 1] as arrays convertible by `np.asarray`.
+        """
+        raise NotImplementedError()
+
+    def predict_frames(self, frames: np.ndarray, batch_size: int = 1):
+        assert len(frames.shape) == 4 and frames.shape[1:] == self.input_size, \
+            "[TransNetV2] Input shape must be [frames, height, width, 3]."
+
+        def input_iterator():
+            # return windows of size 100 where the first/last 25 frames are from the previous/next batch
+            # the first and last window must be padded by copies of the first and last frame of the video
+            no_padded_frames_start = 25
+            no_padded_frames_end = 25 + 50 - (len(frames) % 50 if len(frames) % 50 != 0 else 50)  # 25 - 74
+            no_windows = (no_padded_frames_start + len(frames) + no_padded_frames_end) // 50 - 1
+
+            # windows inside the video are views of `frames` (possibly memory-mapped), only the padded ones
+            # are materialized, so the video is never copied as a whole
+            for ptr in range(-no_padded_frames_start, no_windows * 50 - no_padded_frames_start, 50):
+                if ptr >= 0 and ptr + 100 <= len(frames):
+                    yield frames[ptr:ptr + 100]
+                else:
+                    yield frames[np.clip(np.arange(ptr, ptr + 100), 0, len(frames) - 1)]
+
+        return self._predict_windows(input_iterator(), batch_size, no_frames=len(frames))
+
+    def _predict_windows(self, windows, batch_size: int = 1, no_frames=None, prefetch: int = 0, stats=None):
+        # `windows` yields [100, height, width, 3] arrays, only the middle 50 frames of each window are kept
+        assert batch_size >= 1, "[TransNetV2] Batch size must be a positive integer."
+
+        def batch_iterator():
+            # stack up to `batch_size` consecutive windows into a single [B, 100, 27, 48, 3] input
+            batch = []
+            for window in windows:
+                batch.append(window)
+                if len(batch) == batch_size:
+                    yield np.stack(batch, 0)
+                    batch = []
+            if len(batch) != 0:
+                yield np.stack(batch, 0)
+
+        batches = batch_iterator()
+        if prefetch > 0:
+            # decoding and window preparation run in a background thread while the network is busy
+            batches = _prefetch(batches, prefetch)
+
+        single_frame_pred, all_frames_pred = [np.zeros([0], np.float32)], [np.zeros([0], np.float32)]
+        for inp in batches:
+            start_time = time.perf_counter()
+            single_, all_ = self.predict_raw(inp)
+            single_, all_ = np.asarray(single_), np.asarray(all_)
+            if stats is not None:
+                stats.add(len(inp) * 50, time.perf_counter() - start_time)
+
+            single_frame_pred.extend(single_[:, 25:75, 0])
+            all_frames_pred.extend(all_[:, 25:75, 0])
+
+            if self.show_progress:
+                no_predicted_frames = (len(single_frame_pred) - 1) * 50
+                if no_frames is not None:
+                    print(f"\r[TransNetV2] Processing video frames {min(no_predicted_frames, no_frames)}/{no_frames}",
+                          end="")
+                else:
+                    print(f"\r[TransNetV2] Processing video frames {no_predicted_frames}", end="")
+        if self.show_progress:
+            print("")
+
+        single_frame_pred, all_frames_pred = np.concatenate(single_frame_pred), np.concatenate(all_frames_pred)
+        if no_frames is None:
+            return single_frame_pred, all_frames_pred
+        return single_frame_pred[:no_frames], all_frames_pred[:no_frames]  # remove extra padded frames
+
+    def predict_video(self, video_fn: str, batch_size: int = 1, stream: bool = False, chunk_size: int = 1000,
+                      prefetch: int = 4, frames_path: str = None):
+        """
+        Returns decoded frames and both predictions for the video file `video_fn`.
+
+        Frames are always read from ffmpeg in chunks of `chunk_size` frames and fed to the network
+        as soon as a window is complete.
+        stream:
+            If True, decoded frames are not kept and `None` is returned in their place,
+            so memory does not grow with video length.
+        prefetch:
+            Decoding runs in a background thread which keeps up to `prefetch` batches
+            of windows ready for the network. Set to 0 to decode and predict sequentially.
+        frames_path:
+            Path of `.npy` file with decoded frames. If the file exists, frames are memory-mapped from it
+            and the video is not decoded at all, otherwise decoded frames are saved to it.
+            The memory-mapped frames are returned also in the streaming mode.
+        """
+        if frames_path is not None and os.path.exists(frames_path):
+            video = np.load(frames_path, mmap_mode="r")
+            if stream:
+                chunks = (video[i:i + chunk_size] for i in range(0, len(video), chunk_size))
+                return (video, *self.predict_stream(chunks, batch_size, prefetch))
+            return (video, *self.predict_frames(video, batch_size=batch_size))
+
+        try:
+            import ffmpeg
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError("For `predict_video` function `ffmpeg` needs to be installed in order to extract "
+                                      "individual frames from video file. Install `ffmpeg` command line tool and then "
+                                      "install python wrapper by `pip install ffmpeg-python`.")
+
+        try:
+            chunks = self._iterate_video_frames(video_fn, chunk_size)
+            if frames_path is not None:
+                chunks = _save_frames_while_iterating(chunks, frames_path, self.input_size)
+            decoded_chunks = []
+            if not stream and frames_path is None:
+                chunks = _keep_chunks(chunks, decoded_chunks)
+
+            # decoding overlaps with inference in both modes, only the decoded frames are kept or dropped
+            single_frame_pred, all_frames_pred = self.predict_stream(chunks, batch_size, prefetch)
+            if frames_path is not None:
+                video = np.load(frames_path, mmap_mode="r")
+            elif stream:
+                video = None
+            else:
+                video = np.concatenate(decoded_chunks) if decoded_chunks \
+                    else np.zeros([0, *self.input_size], dtype=np.uint8)
+            return video, single_frame_pred, all_frames_pred
+        except ffmpeg.Error as exc:
+            # stderr is kept also by the worker processes of `transnetv2.main`, which silence stdout
+            print(f"[TransNetV2] Error while extracting frames from {video_fn} with error message {exc.stderr.decode()}.",
+                  file=sys.stderr)
+            return None, None, None
+
+    def predict_stream(self, chunks, batch_size: int = 1, prefetch: int = 4):
+        """Predicts frames coming in chunks (np.uint8 arrays [n, 27, 48, 3]) of arbitrary size with bounded memory."""
+        windows = SlidingWindows()
+        decode_stats, inference_stats = StageThroughput("decoding"), StageThroughput("inference")
+
+        def input_iterator():
+            for frames in timed(chunks, decode_stats):
+                yield from windows.push(frames)
+            yield from windows.finish()
+
+        single_frame_pred, all_frames_pred = self._predict_windows(
+            input_iterator(), batch_size, prefetch=prefetch, stats=inference_stats)
+        print(f"[TransNetV2] Throughput of {decode_stats}, {inference_stats}.")
+        # remove extra padded frames
+        return single_frame_pred[:windows.no_frames], all_frames_pred[:windows.no_frames]
+
+    def _iterate_video_frames(self, video_fn: str, chunk_size: int = 1000):
+        # yields [<=chunk_size, 27, 48, 3] uint8 arrays read directly from the ffmpeg rawvideo pipe
+        height, width, _ = self.input_size
+        return iterate_video_chunks(video_fn, chunk_size, height, width)
+
+    @staticmethod
+    def predictions_to_scenes(predictions: np.ndarray, threshold: float = 0.5):
+        return predictions_to_scenes(predictions, threshold)
+
+
+def read_frames_into(stream, buffer):
+    """
+    Fills uint8 array `buffer` of shape [n, height, width, 3] with raw frames read from `stream`,
+    returns the number of complete frames read, smaller than n only at the end of the stream.
+    """
+    data = memoryview(buffer.reshape(-1))
+    frame_size = int(np.prod(buffer.shape[1:]))
+    num_bytes = 0
+    while num_bytes < len(data):
+        n = stream.readinto(data[num_bytes:])
+        if not n:
+            break
+        num_bytes += n
+    return num_bytes // frame_size
+
+
+@contextlib.contextmanager
+def open_video_pipe(video_path: str, height: int = 27, width: int = 48):
+    """
+    Starts a single ffmpeg process decoding `video_path` into raw rgb24 frames of size `height`x`width`,
+    yields its stdout to be read by `read_frames_into`, raises `ffmpeg.Error` if decoding failed.
+    """
+    import ffmpeg
+
+    process = (
+        ffmpeg.input(video_path)
+        .output("pipe:", format="rawvideo", pix_fmt="rgb24", s=f"{width}x{height}")
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+
+    try:
+        yield process.stdout
+    finally:
+        process.stdout.close()
+        err = process.stderr.read()
+        process.stderr.close()
+        return_code = process.wait()
+
+    if return_code != 0:
+        raise ffmpeg.Error("ffmpeg", None, err)
+
+
+def iterate_video_chunks(video_path: str, chunk_size: int = 1000, height: int = 27, width: int = 48):
+    """Decodes `video_path` by a single ffmpeg rawvideo pipe, yields uint8 arrays [<=chunk_size, height, width, 3]."""
+    with open_video_pipe(video_path, height, width) as stream:
+        while True:
+            # a new buffer for each chunk, the previous one can still be used by the consumer
+            buffer = np.empty([chunk_size, height, width, 3], dtype=np.uint8)
+            num_frames = read_frames_into(stream, buffer)
+            if num_frames > 0:
+                yield buffer[:num_frames]
+            if num_frames < chunk_size:
+                break
+
+
+def _npy_header(shape, header_size: int = 128):
+    # header of uint8 .npy file (format version 1.0) padded to a fixed size,
+    # so it can be rewritten in place once the number of frames is known
+    header = "{'descr': '|u1', 'fortran_order': False, 'shape': %s, }" % repr(tuple(shape))
+    header = header.ljust(header_size - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def _save_frames_while_iterating(chunks, frames_path: str, frame_shape):
+    """
+    Passes through chunks of frames while appending them to `.npy` file `frames_path`.
+    The file is written under a temporary name and moved to `frames_path` only when all chunks were written,
+    so an interrupted decoding never leaves an incomplete frames file behind.
+    """
+    tmp_path = f"{frames_path}.{os.getpid()}.tmp"
+    no_frames = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(_npy_header((0, *frame_shape)))
+            for frames in chunks:
+                f.write(np.ascontiguousarray(frames, dtype=np.uint8).tobytes())
+                no_frames += len(frames)
+                yield frames
+
+            f.seek(0)
+            f.write(_npy_header((no_frames, *frame_shape)))
+        os.replace(tmp_path, frames_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _keep_chunks(chunks, kept: list):
+    # passes through chunks of frames while appending them to `kept`
+    for frames in chunks:
+        kept.append(frames)
+        yield frames
+
+
+class StageThroughput:
+    """Accumulates the number of processed frames and the time spent by a single pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.no_frames = 0
+        self.seconds = 0.
+
+    def add(self, no_frames: int, seconds: float):
+        self.no_frames += no_frames
+        self.seconds += seconds
+
+    @property
+    def frames_per_second(self):
+        return self.no_frames / self.seconds if self.seconds > 0 else float("inf")
+
+    def __str__(self):
+        return f"{self.name} {self.frames_per_second:.1f} frames/s"
+
+
+def timed(iterable, stats: StageThroughput, count=len):
+    """
+    Measures how long it takes to produce each item of `iterable`.
+    `count` returns the number of frames contained in an item.
+    """
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.add(count(item), time.perf_counter() - start_time)
+        yield item
+
+
+def prefetch(iterable, max_queue_size: int = 2):
+    """
+    Iterates `iterable` in a background thread and yields its items in order, so that producing
+    the next items (e.g. decoding frames) overlaps with consuming the current one (e.g. model inference).
+    At most `max_queue_size` items are buffered, exceptions are re-raised in the consuming thread.
+    """
+    items = queue.Queue(max_queue_size)
+    stop = threading.Event()
+    end_of_iterable = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as exc:
+            put((None, exc))
+            return
+        put((end_of_iterable, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if exc is not None:
+                raise exc
+            if item is end_of_iterable:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+_prefetch = prefetch  # `prefetch` is shadowed by the argument of the same name in `SlidingWindowPredictor`
+
+
+def test_predictors(predictor_a: SlidingWindowPredictor, predictor_b: SlidingWindowPredictor, name: str):
+    """Prints how closely `predict_frames` of two backends match on random videos, `name` describes the backends."""
+    print(f"Tests: comparing predict_frames of {name} backends...")
+    for i, no_frames in enumerate([1, 49, 50, 51, 100, 317]):
+        video = np.random.randint(0, 255, size=(no_frames, 27, 48, 3), dtype=np.uint8)
+        single_a, many_a = predictor_a.predict_frames(video, batch_size=4)
+        single_b, many_b = predictor_b.predict_frames(video)
+
+        single = np.isclose(single_a, single_b).mean()
+        many = np.isclose(many_a, many_b).mean()
+        scenes = np.array_equal(predictor_a.predictions_to_scenes(single_a),
+                                predictor_b.predictions_to_scenes(single_b))
+
+        print(f"Test {i:2d} ({no_frames:3d} frames): "
+              f"{single * 100:5.1f}% of 'single' predictions matching, "
+              f"{many * 100:5.1f}% of 'many' predictions matching, "
+              f"scenes {'' if scenes else 'not '}matching")
@@ -1,9 +1,20 @@
 import os
+import sys
+import time
+import hashlib
 import numpy as np
 import tensorflow as tf
 
+try:
+    from .prediction_cache import PredictionCache, DEFAULT_CACHE_DIR
+    from .sliding_window import SlidingWindowPredictor, SlidingWindows
+except ImportError:  # run as a script, not as a part of the package
+    from prediction_cache import PredictionCache, DEFAULT_CACHE_DIR
+    from sliding_window import SlidingWindowPredictor, SlidingWindows
 
-class TransNetV2:
+
+class TransNetV2(SlidingWindowPredictor):
+    show_progress = True
 
     def __init__(self, model_dir=None):
         if model_dir is None:
@@ -13,7 +24,8 @@ class TransNetV2:
             else:
                 print(f"[TransNetV2] Using weights from {model_dir}.")
 
-        self._input_size = (27, 48, 3)
+        self._model_dir = model_dir
+        self._fingerprint = None
         try:
             self._model = tf.saved_model.load(model_dir)
         except OSError as exc:
@@ -21,8 +33,24 @@ class TransNetV2:
                           f"Re-download them manually and retry. For more info, see: "
                           f"https://github.com/soCzech/TransNetV2/issues/1#issuecomment-647357796") from exc
 
+    @property
+    def fingerprint(self):
+        """Hash of all files in the weights directory, identifies the model in `PredictionCache`."""
+        if self._fingerprint is None:
+            sha = hashlib.sha256()
+            for dir_path, dir_names, filenames in os.walk(self._model_dir):
+                dir_names.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dir_path, filename)
+                    sha.update(os.path.relpath(path, self._model_dir).encode())
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 22), b""):
+                            sha.update(chunk)
+            self._fingerprint = sha.hexdigest()
+        return self._fingerprint
+
     def predict_raw(self, frames: np.ndarray):
-        assert len(frames.shape) == 5 and frames.shape[2:] == self._input_size, \
+        assert len(frames.shape) == 5 and frames.shape[2:] == self.input_size, \
             "[TransNetV2] Input shape must be [batch, frames, height, width, 3]."
         frames = tf.cast(frames, tf.float32)
 
@@ -32,85 +60,6 @@ class TransNetV2:
 
         return single_frame_pred, all_frames_pred
 
-    def predict_frames(self, frames: np.ndarray):
-        assert len(frames.shape) == 4 and frames.shape[1:] == self._input_size, \
-            "[TransNetV2] Input shape must be [frames, height, width, 3]."
-
-        def input_iterator():
-            # return windows of size 100 where the first/last 25 frames are from the previous/next batch
-            # the first and last window must be padded by copies of the first and last frame of the video
-            no_padded_frames_start = 25
-            no_padded_frames_end = 25 + 50 - (len(frames) % 50 if len(frames) % 50 != 0 else 50)  # 25 - 74
-
-            start_frame = np.expand_dims(frames[0], 0)
-            end_frame = np.expand_dims(frames[-1], 0)
-            padded_inputs = np.concatenate(
-                [start_frame] * no_padded_frames_start + [frames] + [end_frame] * no_padded_frames_end, 0
-            )
-
-            ptr = 0
-            while ptr + 100 <= len(padded_inputs):
-                out = padded_inputs[ptr:ptr + 100]
-                ptr += 50
-                yield out[np.newaxis]
-
-        predictions = []
-
-        for inp in input_iterator():
-            single_frame_pred, all_frames_pred = self.predict_raw(inp)
-            predictions.append((single_frame_pred.numpy()[0, 25:75, 0],
-                                all_frames_pred.numpy()[0, 25:75, 0]))
-
-            print("\r[TransNetV2] Processing video frames {}/{}".format(
-                min(len(predictions) * 50, len(frames)), len(frames)
-            ), end="")
-        print("")
-
-        single_frame_pred = np.concatenate([single_ for single_, all_ in predictions])
-        all_frames_pred = np.concatenate([all_ for single_, all_ in predictions])
-
-        return single_frame_pred[:len(frames)], all_frames_pred[:len(frames)]  # remove extra padded frames
-
-    def predict_video(self, video_fn: str):
-        try:
-            import ffmpeg
-        except ModuleNotFoundError:
-            raise ModuleNotFoundError("For `predict_video` function `ffmpeg` needs to be installed in order to extract "
-                                      "individual frames from video file. Install `ffmpeg` command line tool and then "
-                                      "install python wrapper by `pip install ffmpeg-python`.")
-
-        try:
-            video_stream, err = ffmpeg.input(video_fn).output(
-                "pipe:", format="rawvideo", pix_fmt="rgb24", s="48x27"
-            ).run(capture_stdout=True, capture_stderr=True)
-
-            video = np.frombuffer(video_stream, np.uint8).reshape([-1, 27, 48, 3])
-            return (video, *self.predict_frames(video))
-        except ffmpeg.Error as exc:
-            print(f"[TransNetV2] Error while extracting frames from {video_fn} with error message {exc.stderr.decode()}.")
-            return None, None, None
-
-    @staticmethod
-    def predictions_to_scenes(predictions: np.ndarray, threshold: float = 0.5):
-        predictions = (predictions > threshold).astype(np.uint8)
-
-        scenes = []
-        t, t_prev, start = -1, 0, 0
-        for i, t in enumerate(predictions):
-            if t_prev == 1 and t == 0:
-                start = i
-            if t_prev == 0 and t == 1 and i != 0:
-                scenes.append([start, i])
-            t_prev = t
-        if t == 0:
-            scenes.append([start, i])
-
-        # just fix if all predictions are 1
-        if len(scenes) == 0:
-            return np.array([[0, len(predictions) - 1]], dtype=np.int32)
-
-        return np.array(scenes, dtype=np.int32)
-
     @staticmethod
     def visualize_predictions(frames: np.ndarray, predictions):
         from PIL import Image, ImageDraw
@@ -153,9 +102,190 @@ class TransNetV2:
         return img
 
 
+class StreamingDetector:
+    """
+    Incremental shot boundary detection for live streams built on `TransNetV2.predict_raw`.
+
+    Frames are passed by `push` as they arrive, predictions of a frame are final once the next 75 frames
+    are known (the 100-frame window also needs 25 frames of left context which are kept from previous calls).
+    `flush` ends the stream, padding it by copies of the last frame as `predict_frames` does,
+    so the concatenated outputs are identical to `predict_frames` and `predictions_to_scenes` on the whole video.
+
+    Usage:
+        detector = StreamingDetector(model)
+        for frames in stream:  # np.uint8 arrays of shape [n, 27, 48, 3]
+            single_frame_pred, all_frames_pred, scenes = detector.push(frames)
+        single_frame_pred, all_frames_pred, scenes = detector.flush()
+    """
+
+    latency = 75
+
+    def __init__(self, model: TransNetV2, threshold: float = 0.5, batch_size: int = 1):
+        self.model = model
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        self._windows = SlidingWindows()
+        self._no_predicted_frames = 0  # frames with final predictions
+        self._no_scenes = 0
+        self._last_prediction = 0
+        self._scene_start = 0
+
+    @property
+    def no_frames(self):
+        """Number of frames pushed so far."""
+        return self._windows.no_frames
+
+    def push(self, frames: np.ndarray):
+        """
+        Adds frames of shape [n, 27, 48, 3] to the stream. Returns single-frame and all-frames predictions of
+        the frames which became final and an int32 array [[start, end], ...] of scenes which ended.
+        """
+        assert len(frames.shape) == 4 and frames.shape[1:] == self.model.input_size, \
+            "[TransNetV2] Input shape must be [frames, height, width, 3]."
+        return self._predict(self._windows.push(frames))
+
+    def flush(self):
+        """Ends the stream, returns the remaining predictions and scenes in the same form as `push`."""
+        no_frames = self._windows.no_frames
+        single_frame_pred, all_frames_pred, scenes = self._predict(self._windows.finish(), no_frames)
+
+        scenes = scenes.tolist()
+        if no_frames > 0 and self._last_prediction == 0:
+            # the last scene is not ended by a transition
+            scenes.append([self._scene_start, no_frames - 1])
+        elif no_frames > 0 and self._no_scenes == 0:
+            # just fix if all predictions are 1
+            scenes.append([0, no_frames - 1])
+
+        self.reset()
+        return single_frame_pred, all_frames_pred, np.array(scenes, dtype=np.int32).reshape([-1, 2])
+
+    def _predict(self, windows, no_frames=None):
+        single_frame_pred, all_frames_pred = [np.zeros([0], np.float32)], [np.zeros([0], np.float32)]
+        for i in range(0, len(windows), self.batch_size):
+            single_, all_ = self.model.predict_raw(np.stack(windows[i:i + self.batch_size], 0))
+            single_frame_pred.extend(single_.numpy()[:, 25:75, 0])
+            all_frames_pred.extend(all_.numpy()[:, 25:75, 0])
+
+        single_frame_pred, all_frames_pred = np.concatenate(single_frame_pred), np.concatenate(all_frames_pred)
+        if no_frames is not None:  # remove extra padded frames
+            single_frame_pred = single_frame_pred[:no_frames - self._no_predicted_frames]
+            all_frames_pred = all_frames_pred[:no_frames - self._no_predicted_frames]
+
+        scenes = self._update_scenes(single_frame_pred)
+        self._no_predicted_frames += len(single_frame_pred)
+        return single_frame_pred, all_frames_pred, scenes
+
+    def _update_scenes(self, single_frame_pred):
+        # the same rules as `predictions_to_scenes`, only carried over between calls
+        predictions = (single_frame_pred > self.threshold).astype(np.int8)
+        edges = np.diff(np.concatenate([[self._last_prediction], predictions]))
+
+        scenes = []
+        for i in np.flatnonzero(edges):
+            frame_idx = self._no_predicted_frames + int(i)
+            if edges[i] == -1:
+                self._scene_start = frame_idx
+            elif frame_idx != 0:
+                scenes.append([self._scene_start, frame_idx])
+
+        if len(predictions) > 0:
+            self._last_prediction = predictions[-1]
+        self._no_scenes += len(scenes)
+        return np.array(scenes, dtype=np.int32).reshape([-1, 2])
+
+
+def process_file(model: TransNetV2, file: str, args, cache: PredictionCache = None):
+    """Predicts and saves scenes of a single video file as `main` does, returns status and number of frames."""
+    ext = "." + args.output_format
+    if os.path.exists(file + ".predictions" + ext) or os.path.exists(file + ".scenes" + ext):
+        print(f"[TransNetV2] {file}.predictions{ext} or {file}.scenes{ext} already exists. "
+              f"Skipping video {file}.", file=sys.stderr)
+        return "skipped", 0
+
+    cache_key, cached = None, None
+    if cache is not None:
+        cache_key = cache.key(file, model.fingerprint)
+        cached = cache.get(cache_key)
+
+    frames_path = file + ".frames.npy" if args.save_frames else None
+
+    if cached is not None:
+        print(f"[TransNetV2] Using cached predictions for video {file}.")
+        single_frame_predictions, all_frame_predictions = cached
+        video_frames = None
+        if args.visualize and frames_path is not None and os.path.exists(frames_path):
+            video_frames = np.load(frames_path, mmap_mode="r")
+        elif args.visualize:  # only decoding is needed, not the network
+            video_frames = np.concatenate(list(model._iterate_video_frames(file)))
+    else:
+        video_frames, single_frame_predictions, all_frame_predictions = \
+            model.predict_video(file, batch_size=args.batch_size, stream=args.stream, frames_path=frames_path)
+        if single_frame_predictions is None:
+            return "failed", 0
+        if cache is not None:
+            cache.put(cache_key, single_frame_predictions, all_frame_predictions)
+
+    predictions = np.stack([single_frame_predictions, all_frame_predictions], 1)
+    scenes = model.predictions_to_scenes(single_frame_predictions, threshold=args.threshold)
+
+    if args.output_format == "npy":
+        # binary files can be read back without parsing by `np.load(..., mmap_mode="r")`
+        np.save(file + ".predictions.npy", predictions.astype(np.float16))
+        np.save(file + ".scenes.npy", scenes)
+    else:
+        np.savetxt(file + ".predictions.txt", predictions, fmt="%.6f")
+        np.savetxt(file + ".scenes.txt", scenes, fmt="%d")
+
+    if args.visualize:
+        if os.path.exists(file + ".vis.png"):
+            print(f"[TransNetV2] {file}.vis.png already exists. "
+                  f"Skipping visualization of video {file}.", file=sys.stderr)
+        else:
+            pil_image = model.visualize_predictions(
+                video_frames, predictions=(single_frame_predictions, all_frame_predictions))
+            pil_image.save(file + ".vis.png")
+
+    return "done", len(single_frame_predictions)
+
+
+_worker_model, _worker_cache = None, None
+
+
+def _init_worker(weights, threads, cache_dir, cache_max_size):
+    # each worker process loads the model once and uses only its share of CPU cores
+    global _worker_model, _worker_cache
+    sys.stdout = open(os.devnull, "w")  # per-frame progress of many workers would be unreadable
+
+    if threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    _worker_model = TransNetV2(weights)
+    if cache_dir is not None:
+        _worker_cache = PredictionCache(cache_dir, cache_max_size)
+
+
+def _process_file_safely(model, file, args, cache):
+    # a failing video is recorded as failed, the remaining videos are still processed
+    start_time = time.perf_counter()
+    try:
+        status, no_frames = process_file(model, file, args, cache)
+    except Exception as exc:
+        print(f"[TransNetV2] Failed to process video {file} with error {exc!r}.", file=sys.stderr)
+        status, no_frames = "failed", 0
+    return file, status, no_frames, time.perf_counter() - start_time
+
+
+def _process_file_in_worker(file, args):
+    return _process_file_safely(_worker_model, file, args, _worker_cache)
+
+
 def main():
-    import sys
     import argparse
+    import functools
+    import multiprocessing
 
     parser = argparse.ArgumentParser()
     parser.add_argument("files", type=str, nargs="+", help="path to video files to process")
@@ -163,33 +293,69 @@ def main():
                         help="path to TransNet V2 weights, tries to infer the location if not specified")
     parser.add_argument('--visualize', action="store_true",
                         help="save a png file with prediction visualization for each extracted video")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="number of overlapping 100-frame windows processed by the network in a single call")
+    parser.add_argument("--stream", action="store_true",
+                        help="do not keep decoded frames in memory, keeps memory usage bounded")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes the files are distributed to, each with its own model")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of intra-op threads of each worker (or of the single process), "
+                             "defaults to the number of CPU cores divided by the number of workers")
+    parser.add_argument("--output_format", type=str, choices=["txt", "npy"], default="txt",
+                        help="save predictions and scenes as text files or as binary numpy files "
+                             "(float16 predictions, int32 scenes)")
+    parser.add_argument("--save_frames", action="store_true",
+                        help="save decoded 48x27 frames to /path/to/video.mp4.frames.npy, "
+                             "later runs read them from there instead of decoding the video again")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="threshold on single-frame predictions used to split the video into scenes")
+    parser.add_argument("--cache", action="store_true",
+                        help="reuse raw predictions of already processed videos (matched by content, not by name)")
+    parser.add_argument("--cache_dir", type=str, default=DEFAULT_CACHE_DIR,
+                        help=f"path to the prediction cache, default {DEFAULT_CACHE_DIR}")
+    parser.add_argument("--cache_max_size", type=float, default=None,
+                        help="maximum size of the prediction cache in MB, least recently used entries are removed")
     args = parser.parse_args()
 
-    model = TransNetV2(args.weights)
-    for file in args.files:
-        if os.path.exists(file + ".predictions.txt") or os.path.exists(file + ".scenes.txt"):
-            print(f"[TransNetV2] {file}.predictions.txt or {file}.scenes.txt already exists. "
-                  f"Skipping video {file}.", file=sys.stderr)
-            continue
-
-        video_frames, single_frame_predictions, all_frame_predictions = \
-            model.predict_video(file)
-
-        predictions = np.stack([single_frame_predictions, all_frame_predictions], 1)
-        np.savetxt(file + ".predictions.txt", predictions, fmt="%.6f")
-
-        scenes = model.predictions_to_scenes(single_frame_predictions)
-        np.savetxt(file + ".scenes.txt", scenes, fmt="%d")
-
-        if args.visualize:
-            if os.path.exists(file + ".vis.png"):
-                print(f"[TransNetV2] {file}.vis.png already exists. "
-                      f"Skipping visualization of video {file}.", file=sys.stderr)
-                continue
-
-            pil_image = model.visualize_predictions(
-                video_frames, predictions=(single_frame_predictions, all_frame_predictions))
-            pil_image.save(file + ".vis.png")
+    if args.stream and args.visualize and not args.save_frames:
+        parser.error("--visualize needs all decoded frames and can be combined with --stream only with --save_frames")
+    if args.workers < 1:
+        parser.error("--workers must be a positive integer")
+
+    cache_dir = args.cache_dir if args.cache else None
+    cache_max_size = int(args.cache_max_size * 2 ** 20) if args.cache_max_size is not None else None
+
+    start_time = time.perf_counter()
+    results = []
+
+    if args.workers == 1:
+        if args.threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        model = TransNetV2(args.weights)
+        cache = PredictionCache(cache_dir, cache_max_size) if cache_dir is not None else None
+        for file in args.files:
+            results.append(_process_file_safely(model, file, args, cache))
+    else:
+        threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // args.workers)
+        # tensorflow runtime is not fork-safe, workers must start from a clean interpreter
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(args.workers, initializer=_init_worker,
+                          initargs=(args.weights, threads, cache_dir, cache_max_size)) as pool:
+            for result in pool.imap_unordered(functools.partial(_process_file_in_worker, args=args), args.files):
+                results.append(result)
+                file, status, no_frames, seconds = result
+                print(f"[TransNetV2] [{len(results)}/{len(args.files)}] {file}: {status} "
+                      f"({no_frames} frames in {seconds:.1f}s)")
+
+    elapsed_time = time.perf_counter() - start_time
+    total_frames = sum(no_frames for _, _, no_frames, _ in results)
+    failed = [file for file, status, _, _ in results if status == "failed"]
+    print(f"[TransNetV2] Processed {sum(status == 'done' for _, status, _, _ in results)} videos "
+          f"({total_frames} frames) in {elapsed_time:.1f}s, {total_frames / max(elapsed_time, 1e-9):.1f} frames/s; "
+          f"skipped {sum(status == 'skipped' for _, status, _, _ in results)}, failed {len(failed)}.")
+    for file in failed:
+        print(f"[TransNetV2] Failed video: {file}", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -12,6 +12,7 @@ setup(
     entry_points={
         "console_scripts": [
             "transnetv2_predict = transnetv2.transnetv2:main",
+            "transnetv2_cache = transnetv2.prediction_cache:main",
         ]
     },
     packages=["transnetv2"],
@@ -5,22 +5,25 @@ plt.switch_backend("agg")
 
 
 def predictions_to_scenes(predictions):
-    scenes = []
-    t, t_prev, start = -1, 0, 0
-    for i, t in enumerate(predictions):
-        if t_prev == 1 and t == 0:
-            start = i
-        if t_prev == 0 and t == 1 and i != 0:
-            scenes.append([start, i])
-        t_prev = t
-    if t == 0:
-        scenes.append([start, i])
+    predictions = (np.asarray(predictions).reshape(-1) != 0).astype(np.int8)
+    if len(predictions) == 0:
+        return np.array([[0, -1]], dtype=np.int32)
+
+    # edges of the binary signal: -1 where a scene starts, +1 where a transition starts
+    edges = np.diff(predictions)
+    starts = np.flatnonzero(edges == -1) + 1
+    ends = np.flatnonzero(edges == 1) + 1
+
+    if predictions[0] == 0:
+        starts = np.concatenate([[0], starts])
+    if predictions[-1] == 0:
+        ends = np.concatenate([ends, [len(predictions) - 1]])
 
     # just fix if all predictions are 1
-    if len(scenes) == 0:
+    if len(starts) == 0:
         return np.array([[0, len(predictions) - 1]], dtype=np.int32)
 
-    return np.array(scenes, dtype=np.int32)
+    return np.stack([starts, ends], 1).astype(np.int32)
 
 
 def evaluate_scenes(gt_scenes, pred_scenes, return_mistakes=False, n_frames_miss_tolerance=2):
@@ -50,37 +53,18 @@ def evaluate_scenes(gt_scenes, pred_scenes, return_mistakes=False, n_frames_miss
     """
 
     shift = n_frames_miss_tolerance / 2
-    gt_scenes = gt_scenes.astype(np.float32) + np.array([[-0.5 + shift, 0.5 - shift]])
-    pred_scenes = pred_scenes.astype(np.float32) + np.array([[-0.5 + shift, 0.5 - shift]])
-
-    gt_trans = np.stack([gt_scenes[:-1, 1], gt_scenes[1:, 0]], 1)
-    pred_trans = np.stack([pred_scenes[:-1, 1], pred_scenes[1:, 0]], 1)
-
-    i, j = 0, 0
-    tp, fp, fn = 0, 0, 0
-    fp_mistakes, fn_mistakes = [], []
-
-    while i < len(gt_trans) or j < len(pred_trans):
-        if j == len(pred_trans):
-            fn += 1
-            fn_mistakes.append(gt_trans[i])
-            i += 1
-        elif i == len(gt_trans):
-            fp += 1
-            fp_mistakes.append(pred_trans[j])
-            j += 1
-        elif pred_trans[j, 1] < gt_trans[i, 0]:
-            fp += 1
-            fp_mistakes.append(pred_trans[j])
-            j += 1
-        elif pred_trans[j, 0] > gt_trans[i, 1]:
-            fn += 1
-            fn_mistakes.append(gt_trans[i])
-            i += 1
-        else:
-            i += 1
-            j += 1
-            tp += 1
+    gt_trans = gt_scenes.astype(np.float32) + np.array([[-0.5 + shift, 0.5 - shift]])
+    pred_trans = pred_scenes.astype(np.float32) + np.array([[-0.5 + shift, 0.5 - shift]])
+
+    gt_trans = np.stack([gt_trans[:-1, 1], gt_trans[1:, 0]], 1)
+    pred_trans = np.stack([pred_trans[:-1, 1], pred_trans[1:, 0]], 1)
+
+    gt_matched, pred_matched = match_transitions(gt_scenes, [pred_scenes], [n_frames_miss_tolerance])
+    gt_matched, pred_matched = gt_matched[0, 0], pred_matched[0][0]
+
+    tp = int(gt_matched.sum())
+    fp = len(pred_trans) - tp
+    fn = len(gt_trans) - tp
 
     if tp + fp != 0:
         p = tp / (tp + fp)
@@ -97,14 +81,114 @@ def evaluate_scenes(gt_scenes, pred_scenes, return_mistakes=False, n_frames_miss
     else:
         f1 = 0
 
-    assert tp + fn == len(gt_trans)
-    assert tp + fp == len(pred_trans)
-
     if return_mistakes:
+        fp_mistakes, fn_mistakes = list(pred_trans[~pred_matched]), list(gt_trans[~gt_matched])
         return p, r, f1, (tp, fp, fn), fp_mistakes, fn_mistakes
     return p, r, f1, (tp, fp, fn)
 
 
+def match_transitions(gt_scenes, pred_scenes_list, n_frames_miss_tolerances=(2,)):
+    """
+    Matches ground truth and predicted transitions the same way as `evaluate_scenes` for many predicted
+    scene lists (e.g. one per threshold) and many tolerances at once.
+
+    A transition between scenes [.., e] and [s, ..] spans frames (e, s), with tolerance t it is extended to
+    the interval [e + 0.5 - t / 2, s - 0.5 + t / 2]. Both transition lists are sorted by start and end,
+    therefore the predictions overlapping i-th ground truth transition are a contiguous range [lo_i, hi_i)
+    which is found by `np.searchsorted`. Ground truth transitions are then greedily matched to the first
+    overlapping prediction not matched before (see `_greedy_match`).
+
+    Returns:
+        gt_matched: bool array [len(pred_scenes_list), len(n_frames_miss_tolerances), no_gt_transitions]
+        pred_matched: list (one item per predicted scenes) of bool arrays
+            [len(n_frames_miss_tolerances), no_pred_transitions]
+    """
+    gt_ends, gt_next_starts = gt_scenes[:-1, 1].astype(np.int64), gt_scenes[1:, 0].astype(np.int64)
+    tolerances = np.asarray(n_frames_miss_tolerances, dtype=np.float64)[:, np.newaxis]
+
+    lo, hi = [], []
+    for pred_scenes in pred_scenes_list:
+        pred_ends, pred_next_starts = pred_scenes[:-1, 1].astype(np.int64), pred_scenes[1:, 0].astype(np.int64)
+        # a prediction ends before a ground truth transition starts if s_pred < e_gt + 1 - t
+        # and starts after the ground truth transition ends if e_pred > s_gt - 1 + t
+        lo.append(np.searchsorted(pred_next_starts, gt_ends[np.newaxis] + 1 - tolerances, side="left"))
+        hi.append(np.searchsorted(pred_ends, gt_next_starts[np.newaxis] - 1 + tolerances, side="right"))
+
+    # [no_pred_scenes, no_tolerances, no_gt_transitions]
+    gt_matched, matches = _greedy_match(
+        np.array(lo).reshape([len(pred_scenes_list), len(tolerances), len(gt_ends)]),
+        np.array(hi).reshape([len(pred_scenes_list), len(tolerances), len(gt_ends)]))
+
+    pred_matched = []
+    for i, pred_scenes in enumerate(pred_scenes_list):
+        matched = np.zeros([len(tolerances), len(pred_scenes) - 1], dtype=bool)
+        tolerance_idx, gt_idx = np.nonzero(gt_matched[i])
+        matched[tolerance_idx, matches[i, tolerance_idx, gt_idx]] = True
+        pred_matched.append(matched)
+
+    return gt_matched, pred_matched
+
+
+def _greedy_match(lo, hi, max_iterations=8):
+    """
+    The two-pointer scan of `evaluate_scenes` matches i-th ground truth transition to prediction
+    k_i = max(j_i, lo_i) if k_i < hi_i, where j_i is the first prediction not used by previous ground truth.
+    With H_i the number of matches before i, this unrolls to k_i = H_i + max_{m <= i}(lo_m - H_m).
+
+    Matches are found by fixed-point iteration starting from `lo < hi`, each iteration fixes at least the next
+    match in order. Conflicts between neighbours are rare so a few iterations are usually enough,
+    rows not converged after `max_iterations` are finished by the sequential scan. Works along the last axis.
+    """
+    hits = lo < hi
+    if lo.shape[-1] == 0:
+        return hits, lo
+
+    for _ in range(max_iterations):
+        matches_before = np.cumsum(hits, -1) - hits
+        matches = matches_before + np.maximum.accumulate(lo - matches_before, -1)
+        new_hits = matches < hi
+        changed = np.any(new_hits != hits, -1)
+        hits = new_hits
+        if not np.any(changed):
+            return hits, matches
+
+    # a row which did not change in the last iteration is a fixed point, the rest is scanned sequentially
+    for idx in zip(*np.nonzero(changed)):
+        next_free = 0
+        row_hits, row_matches = [], []
+        for lo_i, hi_i in zip(lo[idx].tolist(), hi[idx].tolist()):
+            match = max(next_free, lo_i)
+            row_hits.append(match < hi_i)
+            row_matches.append(match)
+            next_free = match + 1 if match < hi_i else match
+        hits[idx], matches[idx] = row_hits, row_matches
+    return hits, matches
+
+
+def evaluate_scenes_grid(gt_scenes, predictions, thresholds, n_frames_miss_tolerances=(2,)):
+    """
+    Evaluates scene predictions for all combinations of `thresholds` and `n_frames_miss_tolerances`.
+    Results are identical to calling `evaluate_scenes` with `predictions_to_scenes(predictions > threshold)`.
+
+    Returns a dict of arrays of shape [len(thresholds), len(n_frames_miss_tolerances)]
+    with keys "precision", "recall", "f1", "tp", "fp", "fn".
+    """
+    predictions = np.asarray(predictions).reshape(-1)
+    pred_scenes_list = [predictions_to_scenes(predictions > threshold) for threshold in thresholds]
+    gt_matched, _ = match_transitions(gt_scenes, pred_scenes_list, n_frames_miss_tolerances)
+
+    tp = gt_matched.sum(2)
+    fp = np.array([len(pred_scenes) - 1 for pred_scenes in pred_scenes_list])[:, np.newaxis] - tp
+    fn = (len(gt_scenes) - 1) - tp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp != 0, tp / (tp + fp), 0.)
+        recall = np.where(tp + fn != 0, tp / (tp + fn), 0.)
+        f1 = np.where(precision + recall != 0, (precision * recall * 2) / (precision + recall), 0.)
+
+    return {"precision": precision, "recall": recall, "f1": f1, "tp": tp, "fp": fp, "fn": fn}
+
+
 def graph(data, labels=None, marker=""):
     fig = plt.figure(figsize=(6, 6))
 
@@ -141,16 +225,9 @@ def create_scene_based_summaries(one_hot_pred, one_hot_gt, prefix="test", step=0
     thresholds = np.array([
         0.02, 0.06, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9
     ])
-    precision, recall, f1, tp, fp, fn = np.zeros_like(thresholds), np.zeros_like(thresholds),\
-                                        np.zeros_like(thresholds), np.zeros_like(thresholds),\
-                                        np.zeros_like(thresholds), np.zeros_like(thresholds)
-
     gt_scenes = predictions_to_scenes(one_hot_gt)
-    for i in range(len(thresholds)):
-        pred_scenes = predictions_to_scenes(
-            (one_hot_pred > thresholds[i]).astype(np.uint8)
-        )
-        precision[i], recall[i], f1[i], (tp[i], fp[i], fn[i]) = evaluate_scenes(gt_scenes, pred_scenes)
+    results = evaluate_scenes_grid(gt_scenes, one_hot_pred, thresholds)
+    precision, recall, f1, tp, fp, fn = [results[k][:, 0] for k in ["precision", "recall", "f1", "tp", "fp", "fn"]]
 
     best_idx = np.argmax(f1)
     tf.summary.scalar(prefix + "/scene/f1_score_0.1", f1[2], step=step)